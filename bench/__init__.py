@@ -0,0 +1,54 @@
+"""
+Offline benchmarks for the python scripts in src/main/resources.
+
+Run them from the repository root, e.g. `python3 -m bench.regex_bench`, or `python3 -m bench.suite` for the timings of
+each stage of reading a synthetic run, saved as json to compare commits.
+"""
+
+import importlib.util
+import os
+import sys
+import time
+
+RESOURCES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "main", "resources")
+
+
+def load_adegen():
+    """
+    Import adegen.py as a regular module, so process pool workers can import it too
+    :return:
+    """
+    if RESOURCES not in sys.path:
+        sys.path.insert(0, RESOURCES)
+    import adegen
+    return adegen
+
+
+def load_wrapper():
+    """
+    Import sg-upload-v2-wrapper.py, whose file name isn't a valid module name
+    :return:
+    """
+    if "sg_upload_v2_wrapper" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("sg_upload_v2_wrapper",
+                                                      os.path.join(RESOURCES, "sg-upload-v2-wrapper.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+    return sys.modules["sg_upload_v2_wrapper"]
+
+
+def best_of(func, repeat=3):
+    """
+    :param func: callable without arguments
+    :param repeat:
+    :return: (fastest wall time in seconds, result of the last call)
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
@@ -0,0 +1,75 @@
+"""
+End-to-end time of adegen.py on a synthetic run (see bench.runfolder) against bench/fake_uploader.py, with the time
+of each stage from --timings, to measure the orchestration around the uploader calls offline. The uploader startup,
+latency and failures are set as for fake_uploader.py.
+
+    python3 -m bench.e2e_bench [--patients 100 500] [--startup 0.5] [--latency 0.1] [--fail 0] [--batch-workers 1 4]
+"""
+
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import RESOURCES
+from bench.runfolder import generate
+
+FAKE_UPLOADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_uploader.py")
+
+
+def run_adegen(run, env, extra_args, tmp):
+    """
+    :return: (exit code, wall seconds, --timings record)
+    """
+    timings = os.path.join(tmp, "timings.jsonl")
+    if os.path.exists(timings):
+        os.remove(timings)
+    command = [sys.executable, os.path.join(RESOURCES, "adegen.py"), run["root"], "-c", "-d", "-p", "1",
+               "-j", FAKE_UPLOADER, "--cache-ttl", "0", "-o", os.path.join(tmp, "ade.json"), "--timings", timings]
+    command += ["-x", run["regex_file"]] if run["regex_file"] else []
+    start = time.perf_counter()
+    result = subprocess.run(command + extra_args, cwd=tmp, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        print(result.stdout[-2000:], result.stderr[-2000:], sep="\n")
+    with open(timings) as f_in:
+        record = json.loads(f_in.readline())
+    return result.returncode, elapsed, record
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--patients", type=int, nargs="+", default=[100, 500])
+    parser.add_argument("--startup", type=float, default=0.5, help="Seconds the fake uploader takes to start")
+    parser.add_argument("--latency", default="0.1", help="FAKE_UPLOADER_LATENCY, e.g. 0.1 or patient=0.3,0.1")
+    parser.add_argument("--fail", default="0", help="FAKE_UPLOADER_FAIL, e.g. 0.1 or patient=0.2")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--batch-workers", type=int, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+
+    env = dict(os.environ, FAKE_UPLOADER_STARTUP=str(args.startup), FAKE_UPLOADER_LATENCY=args.latency,
+               FAKE_UPLOADER_FAIL=args.fail)
+
+    print(f"{'patients':>8} {'workers':>7} {'code':>4} {'wall':>8} {'uploader':>9} {'calls':>5}  other stages")
+    for patients in args.patients:
+        with tempfile.TemporaryDirectory() as tmp:
+            # About 1.4 samples per patient with the default mix
+            run = generate(os.path.join(tmp, "run"), int(patients * 1.4) * 4, noise=0.05)
+            for workers in args.batch_workers:
+                code, wall, record = run_adegen(run, env, ["--batch-size", str(args.batch_size), "--batch-workers",
+                                                           str(workers)], tmp)
+                stages = collections.defaultdict(float)
+                for stage in record["stages"]:
+                    stages[stage["stage"]] += stage["wall"]
+                calls = sum(1 for _s in record["stages"] if _s["stage"] == "uploader")
+                other = "  ".join(f"{_name} {_wall:.3f}s" for _name, _wall in stages.items() if _name != "uploader")
+                print(f"{run['patients']:8} {workers:7} {code:4} {wall:7.2f}s {stages['uploader']:8.2f}s {calls:5}  "
+                      f"{other}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Time to extract the patient ids from synthetic `patient -l` output, with the previous ALL_PATIENTS_RE search and with
+the raw_decode scan of PatientHelper._extract_patients. The time per patient of the scan should stay flat, also when
+the list is truncated, where the regex backtracks exponentially (so it is only run on a handful of patients).
+
+    python3 -m bench.extract_bench [--sizes 625 1250 2500 5000] [--truncated-regex-sizes 10 14 18 20]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import re
+
+from bench import best_of, load_adegen
+
+ONE_PATIENT_RE = r"{\"medicalInformationId\":\d+,\"personalInformationId\":\d+,\"userRef\":\".+\"}"
+ALL_PATIENTS_RE = rf"(\[{ONE_PATIENT_RE}(,{ONE_PATIENT_RE})*\])"
+
+
+def synthetic_stdout(patients):
+    """
+    Uploader style log lines around a compact json patient list
+    """
+    log = [f"[main] INFO  c.s.u.PatientCommand - patient {_n:05d} requested" for _n in range(patients)]
+    patient_list = [{"medicalInformationId": 500000 + _n, "personalInformationId": 900000 + _n,
+                     "userRef": f"PATIENT{_n:05d}"} for _n in range(patients)]
+    return "\n".join(log + [json.dumps(patient_list, separators=(",", ":")), "[main] INFO  done"]) + "\n"
+
+
+def legacy_extract(stdout):
+    match = re.search(ALL_PATIENTS_RE, stdout)
+    return {_p["userRef"]: (_p["personalInformationId"], _p["medicalInformationId"])
+            for _p in json.loads(match.groups()[0])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[625, 1250, 2500, 5000])
+    parser.add_argument("--truncated-regex-sizes", type=int, nargs="+", default=[10, 14, 18, 20])
+    args = parser.parse_args()
+
+    adegen = load_adegen()
+
+    def _extract(stdout):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return adegen.PatientHelper._extract_patients(stdout)
+
+    print(f"{'patients':>8} {'stdout':>9} {'regex':>10} {'us/patient':>10} {'scan':>10} {'us/patient':>10}")
+    for size in args.sizes:
+        stdout = synthetic_stdout(size)
+        before, expected = best_of(lambda: legacy_extract(stdout))
+        after, result = best_of(lambda: _extract(stdout))
+        assert result == expected, "extractors disagree"
+        print(f"{size:8} {len(stdout) / 1024:8.0f}K {before:9.4f}s {before / size * 1e6:10.2f} "
+              f"{after:9.4f}s {after / size * 1e6:10.2f}")
+
+    print("\nTruncated list (no closing bracket)")
+    for size in args.truncated_regex_sizes:
+        stdout = synthetic_stdout(size).replace("}]", "}", 1)
+        before, _ = best_of(lambda: re.search(ALL_PATIENTS_RE, stdout), repeat=1)
+        print(f"{size:8} {len(stdout) / 1024:8.0f}K {before:9.4f}s {before / size * 1e6:10.2f}")
+    for size in args.sizes:
+        stdout = synthetic_stdout(size).replace("}]", "}", 1)
+        after, result = best_of(lambda: _extract(stdout))
+        assert result is None, "a truncated list shouldn't be found"
+        print(f"{size:8} {len(stdout) / 1024:8.0f}K {'':10} {'':10} {after:9.4f}s {after / size * 1e6:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
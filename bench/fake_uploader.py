@@ -0,0 +1,185 @@
+"""
+Offline stand-in for sg-upload-v2-latest.jar, printing what adegen.py and sg-upload-v2-wrapper.py parse from the real
+uploader, so runs can be timed without the SOPHiA service. Point adegen at it with `--jar bench/fake_uploader.py` or
+SG_UPLOADER_JAR=bench/fake_uploader.py (which the wrapper follows too); .py jars are started with the python running
+the script instead of java.
+
+Supports `patient -c/-l --patient-ref=A,B`, `userInfo`, `pipeline --list`, `new`, `status --id`, `login`, and with
+--client-id the token prompt, which waits for the token on stdin. Patient ids are derived from the refs, so every call
+agrees without shared state. Set with environment variables:
+
+    FAKE_UPLOADER_STARTUP    seconds before anything happens, like the JVM starting (default 0)
+    FAKE_UPLOADER_LATENCY    seconds each call takes, e.g. 0.2, or per command: patient=0.5,userInfo=0.1,0.05
+    FAKE_UPLOADER_FAIL       fraction of calls that fail with exit code 1, same format as the latency
+    FAKE_UPLOADER_PIPELINES  number of pipelines listed (default 3)
+
+    python3 bench/fake_uploader.py [-Dmicronaut.config.files=...] <command> [options]
+"""
+
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+USER_ID = 1000
+CLIENT_ID = 2000
+SEQUENCER_ID = 100
+
+
+def setting(name, command, default=0.0):
+    """
+    :param name: environment variable, either a number or name=number pairs and an optional default number
+    :param command: uploader command, e.g. "patient"
+    :param default:
+    :return: the number for command
+    """
+    value = default
+    for part in os.environ.get(name, "").split(","):
+        key, _, number = part.rpartition("=")
+        if number.strip() == "":
+            continue
+        if key == "":
+            value = float(number)
+        elif key.strip() == command:
+            return float(number)
+    return value
+
+
+def log(message, level="INFO"):
+    print(f"[main] {level:5} c.s.u.FakeUploader - {message}")
+
+
+def patient_ids(p_ref):
+    """
+    :return: (personalInformationId, medicalInformationId) of p_ref, the same in every call
+    """
+    crc = zlib.crc32(p_ref.encode())
+    return 100000000 + crc % 900000000, 100000000 + (crc * 7919) % 900000000
+
+
+def option(args, name):
+    """
+    :return: value of --name=value or --name value in args, or None
+    """
+    for _i, _arg in enumerate(args):
+        if _arg.startswith(f"{name}="):
+            return _arg.split("=", 1)[1]
+        if _arg == name and _i + 1 < len(args):
+            return args[_i + 1]
+    return None
+
+
+def ask_token():
+    coordinates = f"[{random.randint(1, 8)}, {random.choice('ABCDEFGH')}]"
+    sys.stdout.write(f"Please enter token for coordinates {coordinates}: ")
+    sys.stdout.flush()
+    token = sys.stdin.read().strip()
+    print()
+    if token == "":
+        log("No token given", "ERROR")
+        return False
+    return True
+
+
+def patient(args):
+    refs = option(args, "--patient-ref")
+    if refs is None or ("-c" not in args and "-l" not in args):
+        log("patient needs -c or -l and --patient-ref", "ERROR")
+        return 2
+    refs = [_r for _r in refs.split(",") if _r]
+
+    if "-c" in args:
+        for p_ref in refs:
+            log(f"Patient {p_ref} created")
+        return 0
+
+    log(f"Listing {len(refs)} patients")
+    patients = []
+    for p_ref in refs:
+        personal, medical = patient_ids(p_ref)
+        # Same key order as the real uploader
+        patients.append({"medicalInformationId": medical, "personalInformationId": personal, "userRef": p_ref})
+    print(json.dumps(patients, separators=(",", ":")))
+    return 0
+
+
+def user_info(args):
+    print(json.dumps({"userId": USER_ID, "clientId": CLIENT_ID, "login": "fake"}))
+    return 0
+
+
+def pipeline(args):
+    if "--list" not in args:
+        log("pipeline needs --list", "ERROR")
+        return 2
+    count = int(os.environ.get("FAKE_UPLOADER_PIPELINES", "3"))
+    print(json.dumps([{"pipeline_id": _p, "pipeline_name": f"Fake pipeline {_p}", "sequencer_id": SEQUENCER_ID + _p}
+                      for _p in range(1, count + 1)]))
+    return 0
+
+
+def new(args):
+    ade = option(args, "-j")
+    if ade is None:
+        log("new needs -j <ADE json>", "ERROR")
+        return 2
+    try:
+        with open(ade) as f_in:
+            analyses = json.load(f_in)["request"]["analyses"]
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        log(f"Invalid ADE {ade}: {err}", "ERROR")
+        return 1
+
+    upload_id = 200000000 + zlib.crc32(ade.encode()) % 100000000
+    log(f"Upload created with id: {upload_id}")
+    files = [_f for _a in analyses for _f in _a.get("files", [])]
+    for _n in range(1, len(files) + 1):
+        log(f"Uploading {_n}/{len(files)} files {100 * _n // len(files)}%")
+    log(f"Upload {upload_id} complete")
+    return 0
+
+
+def status(args):
+    upload_id = option(args, "--id")
+    if upload_id is None or not upload_id.isdigit():
+        log("status needs --id <upload id>", "ERROR")
+        return 2
+    print(json.dumps({"id": int(upload_id), "status": "COMPLETED"}))
+    return 0
+
+
+def login(args):
+    if option(args, "-u") is None or option(args, "-p") is None:
+        log("login needs -u and -p", "ERROR")
+        return 2
+    log("Login successful")
+    return 0
+
+
+COMMANDS = {"patient": patient, "userInfo": user_info, "pipeline": pipeline, "new": new, "status": status,
+            "login": login}
+
+
+def main():
+    args = [_a for _a in sys.argv[1:] if not _a.startswith("-D")]
+    command = args[0] if args else ""
+
+    time.sleep(setting("FAKE_UPLOADER_STARTUP", command))
+    if command not in COMMANDS:
+        print(f"Unknown command {command!r}, expected one of {', '.join(COMMANDS)}", file=sys.stderr)
+        return 2
+
+    if "--client-id" in args and not ask_token():
+        return 1
+
+    time.sleep(setting("FAKE_UPLOADER_LATENCY", command))
+    if random.random() < setting("FAKE_UPLOADER_FAIL", command):
+        print(f"[main] ERROR c.s.u.FakeUploader - Injected failure of {command}", file=sys.stderr)
+        return 1
+    return COMMANDS[command](args[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
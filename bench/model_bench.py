@@ -0,0 +1,222 @@
+"""
+Peak memory and time of building an ADE from classified files, before (dicts of [tag, file, ...] lists, sorted
+through a copy and with the tags worked out again by each consumer) and after (Patient/Sample objects with __slots__
+and tags computed as samples are added).
+
+    python3 -m bench.model_bench [--samples 50000]
+"""
+
+import argparse
+import io
+import itertools
+import json
+import random
+import time
+import tracemalloc
+
+from bench import best_of, load_adegen
+
+
+def legacy_update_patient(patients, p_ref, s_id, tag, file):
+    if p_ref in patients:
+        if s_id in patients[p_ref]:
+            patients[p_ref][s_id].append(file)
+        else:
+            patients[p_ref][s_id] = [tag, file]
+    else:
+        patients[p_ref] = {s_id: [tag, file]}
+
+
+def legacy_sort_patients(patients):
+    ids2p_ref = dict()
+    for p_ref, samples in patients.items():
+        for _id in samples.keys():
+            ids2p_ref[_id] = p_ref
+    sorted_ids = list(ids2p_ref.keys())
+    sorted_ids.sort()
+
+    sorted_patients = dict()
+    for _id in sorted_ids:
+        p_ref = ids2p_ref[_id]
+        if p_ref in sorted_patients:
+            sorted_patients[p_ref][_id] = patients[p_ref][_id]
+        else:
+            sorted_patients[p_ref] = {_id: patients[p_ref][_id]}
+    return sorted_patients
+
+
+def legacy_is_valid(patient_data):
+    valid = True
+    for p_ref, samples in patient_data.items():
+        tags = [samples[s_id][0] for s_id in samples.keys()]
+        if len(samples) == 2:
+            if not ("D" in tags and "R" in tags) and not ("N" in tags and "T" in tags) and tags != ["", ""]:
+                valid = False
+        elif len(samples) == 1:
+            if tags[0] not in ["", "D", "R"]:
+                valid = False
+        else:
+            valid = False
+    return valid
+
+
+def legacy_analyses(adegen, patient_data, patient_ids):
+    for patient_ref, samples in patient_data.items():
+        for sample_id, data in samples.items():
+            tag = data[0]
+            yield {
+                "definition": {
+                    "sampleId": sample_id,
+                    "multiplexId": sample_id,
+                    "sgaPipelineId": 1,
+                    "userRef": patient_ref if len(tag) == 0 else f"{patient_ref}-{tag}",
+                    "sampleTypeId": 108000,
+                    "libraryType": adegen.JsonBuilder.lib_type[tag],
+                },
+                "patient": dict(zip(("personalInformationId", "medicalInformationId"), patient_ids[patient_ref])),
+                "isControlSample": False,
+                "files": [{"definition": {"name": file}} for file in data[1:]]
+            }
+
+
+def legacy_topologies(adegen, patient_data):
+    topologies = []
+    for samples in patient_data.values():
+        tags = [val[0] for val in samples.values()]
+        tags.sort()
+        if len(tags) != 2 or (tags != ["D", "R"] and (tags != ["N", "T"])):
+            continue
+        topologies.append({
+            "definition": {"type": adegen.JsonBuilder.top_type[tags[0]]},
+            "references": [{"analysisReference": {"sampleId": sample_id}, "role": adegen.JsonBuilder.role[data[0]],
+                            "metadata": {}} for sample_id, data in samples.items()]
+        })
+    return topologies
+
+
+def legacy_model(adegen, matches):
+    patients = dict()
+    for match, file in matches:
+        legacy_update_patient(patients, *match, file)
+    patients = legacy_sort_patients(patients)
+    assert legacy_is_valid(patients)
+    ids = {p_ref: (_i, _i) for _i, p_ref in enumerate(patients)}
+    return patients, ids, legacy_topologies(adegen, patients)
+
+
+def legacy_build(adegen, matches, sink=None):
+    """
+    :param sink: file the ADE is written to, or None to only build the analyses without encoding them
+    """
+    patients, ids, topologies = legacy_model(adegen, matches)
+    if sink is None:
+        for _ in legacy_analyses(adegen, patients, ids):
+            pass
+        return
+    ade = {
+        "protocolName": "ADE",
+        "protocolVersion": "1",
+        "client": {"id": 2, "userId": 1},
+        "request": {
+            "definition": {"userRef": "run", "sequencerId": 3, "requestDate": int(time.time()), "isPairedEnd": True,
+                           "isPrevent": False},
+            "state": None,
+            "analyses": adegen.StreamedList(legacy_analyses(adegen, patients, ids)),
+            "topology": topologies,
+            "files": []
+        }
+    }
+    for chunk in json.JSONEncoder(indent=3).iterencode(ade):
+        sink.write(chunk)
+
+
+def model_build(adegen, matches, sink=None):
+    patients = dict()
+    for match, file in matches:
+        adegen.PatientHelper.update_patient(patients, *match, file)
+    patients = adegen.PatientHelper._sort_patients(patients)
+    assert adegen.PatientHelper.is_valid(patients)
+    ids = {p_ref: (_i, _i) for _i, p_ref in enumerate(patients)}
+    if sink is None:
+        for _ in itertools.chain(adegen.JsonBuilder._iter_analyses(patients, ids, 1, 108000),
+                                 adegen.JsonBuilder._iter_topologies(patients)):
+            pass
+        return
+    adegen.JsonBuilder.write_json(sink, "run", 1, 2, 1, 3, patients, ids, 108000)
+
+
+class CountingSink:
+    """
+    Stands in for the output file so only the document model is measured
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+
+
+def synthetic_matches(samples, seed=1):
+    """
+    RegexHelper matches of a run with a mix of single sample, D/R and N/T patients, two lanes and two reads each
+    """
+    rnd = random.Random(seed)
+    sample_ids = rnd.sample(range(10 * samples), samples + 1)
+    matches = []
+    p_ref = 0
+    while len(sample_ids) > 1:
+        p_ref += 1
+        for tag in rnd.choice([[""], ["D"], ["R"], ["D", "R"], ["N", "T"]]):
+            s_id = f"S{sample_ids.pop()}"
+            for lane in (1, 2):
+                for read in (1, 2):
+                    file = f"/run/P{p_ref:06d}{'-' + tag if tag else ''}_{s_id}_L00{lane}_R{read}_001.fastq.gz"
+                    matches.append(((f"P{p_ref:06d}", s_id, tag), file))
+    rnd.shuffle(matches)
+    return matches
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--samples", type=int, default=50000)
+    args = parser.parse_args()
+
+    adegen = load_adegen()
+    matches = synthetic_matches(args.samples)
+    patients = {_match[0] for _match, _ in matches}
+    samples = {_match[1] for _match, _ in matches}
+
+    # Same document either way
+    legacy_out, model_out = io.StringIO(), io.StringIO()
+    now = time.time
+    time.time = lambda: 0
+    try:
+        legacy_build(adegen, matches, legacy_out)
+        model_build(adegen, matches, model_out)
+    finally:
+        time.time = now
+    assert legacy_out.getvalue() == model_out.getvalue(), "the ADE differs"
+
+    print(f"{len(matches)} files, {len(samples)} samples, {len(patients)} patients")
+    # The patients and analyses on their own, then with the ADE encoded, which costs the same either way
+    for label, sink, repeat in [("model", lambda: None, 3), ("ADE", CountingSink, 1)]:
+        before, _ = best_of(lambda: legacy_build(adegen, matches, sink()), repeat)
+        after, _ = best_of(lambda: model_build(adegen, matches, sink()), repeat)
+        before_peak = peak_memory(lambda: legacy_build(adegen, matches, sink()))
+        after_peak = peak_memory(lambda: model_build(adegen, matches, sink()))
+        print(f"{label:6} time before {before:6.2f}s  after {after:6.2f}s  x{before / after:.2f}   "
+              f"peak before {before_peak / 1e6:6.1f} MB  after {after_peak / 1e6:6.1f} MB  "
+              f"x{before_peak / after_peak:.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Files/second of RegexHelper classification, before (one re.search per expression with the breakdown
+assembled character by character) and after (one combined alternation dispatched on lastgroup).
+
+    python3 -m bench.regex_bench [--files 100000]
+"""
+
+import argparse
+import os
+import random
+import re
+import tempfile
+
+from bench import best_of, load_adegen
+
+# Lab specific patterns in front of the Illumina one, as found in -x override files
+LAB_EXPRS = [
+    (rf"^LAB{_i:02d}-(\d+)-([A-Z]{{2}})_([DRTN])_R[12]\.fq\.gz$", ["LAB-0", "01", "2"]) for _i in range(14)
+]
+
+
+def legacy_functions(exprs):
+    """
+    RegexHelper.build_functions as it was before the combined matcher
+    """
+
+    def _build_function(regex, p_ref_ex, mid_ex, tag_ex):
+        def _func(filename):
+            basename = os.path.basename(filename)
+            match = re.search(regex, basename)
+            if match:
+                p_ref = "".join([match.groups()[int(_c)] if _c.isdigit() else _c for _c in p_ref_ex])
+                mid = "".join([match.groups()[int(_c)] if _c.isdigit() else _c for _c in mid_ex])
+                tag = ""
+                try:
+                    tag = "".join([match.groups()[int(_c)] if _c.isdigit() else _c for _c in tag_ex])
+                except TypeError:
+                    pass
+                return p_ref, mid, tag
+            return None
+
+        return _func
+
+    return [_build_function(re.compile(_e[0]), _e[1][0], _e[1][1], _e[1][2] if len(_e[1]) == 3 else None)
+            for _e in exprs]
+
+
+def legacy_match(functions, filename):
+    for _func in functions:
+        match = _func(filename)
+        if match:
+            return match
+    return None
+
+
+def synthetic_names(count, seed=1):
+    """
+    Mix of Illumina names (with and without tags), lab specific names and non-FastQ noise
+    """
+    rnd = random.Random(seed)
+    names = []
+    for _n in range(count):
+        kind = rnd.random()
+        if kind < 0.6:
+            tag = rnd.choice(["", "-D", "-R", "-N", "-T"])
+            names.append(f"/run/fq/P{_n:06d}{tag}_S{_n % 384 + 1}_L00{rnd.randint(1, 4)}_R{rnd.randint(1, 2)}"
+                         f"_001.fastq.gz")
+        elif kind < 0.9:
+            names.append(f"/run/fq/LAB{rnd.randint(0, 13):02d}-{_n}-AB_{rnd.choice('DRTN')}_R1.fq.gz")
+        else:
+            names.append(f"/run/fq/Undetermined_{_n}_unknown.fastq.gz")
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=100000)
+    args = parser.parse_args()
+
+    adegen = load_adegen()
+    names = synthetic_names(args.files)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        override = os.path.join(tmp, "regex.txt")
+        exprs = LAB_EXPRS + [(adegen.RegexHelper.ILLUMINA_RE, adegen.RegexHelper.ILLUMINA_BREAKDOWN)]
+        with open(override, "w") as f_out:
+            for _regex, breakdown in exprs:
+                f_out.write(f"{_regex}\n{' '.join(breakdown)}\n")
+
+        for label, regex_file in [("illumina", None), (f"{len(exprs)} patterns", override)]:
+            helper = adegen.RegexHelper(regex_file)
+            functions = legacy_functions(helper.exprs)
+
+            before, expected = best_of(lambda: [legacy_match(functions, _n) for _n in names])
+            after, result = best_of(lambda: [helper.match(_n) for _n in names])
+            assert result == expected, "combined matcher disagrees with the per-expression functions"
+
+            print(f"{label:12} before {len(names) / before:12,.0f} files/s   after {len(names) / after:12,.0f} "
+                  f"files/s   x{before / after:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Synthetic sequencer run folders: empty FastQ files named like a run, with one or two samples per patient, D/R/N/T tags,
+several lanes and read pairs, nested folders and noise (non-FastQ files, undetermined reads, FastQs inside folders
+adegen excludes). With the custom layout the files follow a lab naming scheme and a -x regex file is written next to
+them.
+
+    python3 -m bench.runfolder DIR [--files 10000] [--layout illumina|custom] [--depth 4] [--noise 0.1]
+"""
+
+import argparse
+import os
+import random
+
+# Shapes of the patients, as the tags of their samples. All of them pass PatientHelper.is_valid
+PATIENT_KINDS = {
+    "single": ("",),
+    "D": ("D",),
+    "R": ("R",),
+    "DR": ("D", "R"),
+    "NT": ("N", "T"),
+}
+
+# Folders between the run and the FastQs, deeper levels are numbered
+RUN_DIRS = ["Data", "Intensities", "BaseCalls"]
+
+# Regex file for the custom layout, as read by RegexHelper.load_expressions
+CUSTOM_REGEX = r"^RUN(\d+)_(\d+)(?:_([DRTN]))?_lane\d+_R[12]\.fq\.gz$" + "\nP0 X1 2\n"
+
+NOISE_FILES = ["SampleSheet.csv", "RunInfo.xml", "md5sums.txt", "{name}.fastq", "{name}.fastq.gz.md5"]
+
+
+def fastq_name(layout, p_ref, sample, tag, lane, read):
+    """
+    :param layout: "illumina" or "custom"
+    :param p_ref: patient number
+    :param sample: sample number, unique in the run
+    :param tag: "", "D", "R", "N" or "T"
+    :param lane:
+    :param read: 1 or 2
+    :return: file name
+    """
+    if layout == "illumina":
+        return f"P{p_ref:06d}{'-' + tag if tag else ''}_S{sample}_L{lane:03d}_R{read}_001.fastq.gz"
+    return f"RUN{p_ref:06d}_{sample}{'_' + tag if tag else ''}_lane{lane}_R{read}.fq.gz"
+
+
+def sample_dir(root, depth, p_ref, projects):
+    """
+    :return: folder of the FastQs of patient p_ref, depth levels below root
+    """
+    if depth == 0:
+        return root
+    levels = (RUN_DIRS + [f"Level{_i}" for _i in range(len(RUN_DIRS), depth)])[:depth - 1]
+    return os.path.join(root, *levels, f"Project_{p_ref % projects}")
+
+
+def generate(root, files=10000, lanes=2, reads=2, kinds=None, noise=0.1, depth=4, projects=8, layout="illumina",
+             seed=1):
+    """
+    Create a run folder in root with about files FastQ files that adegen accepts, plus noise it has to skip
+    :param root: folder to create the run in
+    :param files: number of FastQ files, rounded down to whole samples
+    :param lanes: lanes per sample
+    :param reads: 1 for single end, 2 for read pairs
+    :param kinds: names of PATIENT_KINDS to pick patients from (default all)
+    :param noise: other files per FastQ, spread over non-FastQ files, undetermined reads and excluded folders
+    :param depth: folder levels between root and the FastQs
+    :param projects: number of folders the patients are spread over
+    :param layout: "illumina" for bcl2fastq names, "custom" for lab names read through a regex file
+    :param seed:
+    :return: dict with the run root, the regex file (or None), and the number of FastQs, samples, patients and noise
+             files created
+    """
+    if layout not in ("illumina", "custom"):
+        raise ValueError(f"unknown layout {layout}")
+    rnd = random.Random(seed)
+    shapes = [PATIENT_KINDS[_k] for _k in (kinds or PATIENT_KINDS)]
+    per_sample = lanes * reads
+
+    os.makedirs(root, exist_ok=True)
+    regex_file = None
+    if layout == "custom":
+        regex_file = os.path.join(root, "regex.txt")
+        with open(regex_file, "w") as f_out:
+            f_out.write(CUSTOM_REGEX)
+
+    created = {"fastq": 0, "samples": 0, "patients": 0, "noise": 0}
+    made_dirs = set()
+
+    def _touch(folder, name):
+        if folder not in made_dirs:
+            os.makedirs(folder, exist_ok=True)
+            made_dirs.add(folder)
+        open(os.path.join(folder, name), "w").close()
+
+    samples = files // per_sample
+    while created["samples"] < samples:
+        created["patients"] += 1
+        p_ref = created["patients"]
+        folder = sample_dir(root, depth, p_ref, projects)
+        shape = rnd.choice(shapes)
+        if len(shape) > samples - created["samples"]:
+            # A lone N or T sample would be invalid
+            shape = ("",)
+        for tag in shape:
+            created["samples"] += 1
+            for lane in range(1, lanes + 1):
+                for read in range(1, reads + 1):
+                    _touch(folder, fastq_name(layout, p_ref, created["samples"], tag, lane, read))
+                    created["fastq"] += 1
+
+    run_dir = os.path.dirname(sample_dir(root, depth, 0, projects)) if depth > 0 else root
+    for _n in range(int(created["fastq"] * noise)):
+        kind = _n % 4
+        if kind == 0:
+            _touch(sample_dir(root, depth, _n, projects), NOISE_FILES[_n % len(NOISE_FILES)].format(name=f"x{_n}"))
+        elif kind == 1:
+            # No sample number adegen accepts
+            _touch(run_dir, f"Undetermined_S0_L{_n % lanes + 1:03d}_R1_{_n:03d}.fastq.gz")
+        elif kind == 2:
+            _touch(os.path.join(root, "InterOp"), f"P{_n:06d}_S{_n + 1}_L001_R1_001.fastq.gz")
+        else:
+            _touch(os.path.join(root, "Thumbnail_Images", f"L{_n % lanes + 1:03d}"), f"s_{_n}.jpg")
+        created["noise"] += 1
+
+    return dict(root=root, regex_file=regex_file, **created)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("root")
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--lanes", type=int, default=2)
+    parser.add_argument("--reads", type=int, choices=[1, 2], default=2)
+    parser.add_argument("--kinds", nargs="+", choices=list(PATIENT_KINDS))
+    parser.add_argument("--noise", type=float, default=0.1)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--projects", type=int, default=8)
+    parser.add_argument("--layout", choices=["illumina", "custom"], default="illumina")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    run = generate(args.root, args.files, args.lanes, args.reads, args.kinds, args.noise, args.depth, args.projects,
+                   args.layout, args.seed)
+    print(f"{run['fastq']} FastQs, {run['samples']} samples, {run['patients']} patients and {run['noise']} other "
+          f"files in {run['root']}")
+    if run["regex_file"]:
+        print(f"Run adegen with -x {run['regex_file']}")
+
+
+if __name__ == "__main__":
+    main()
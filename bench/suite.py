@@ -0,0 +1,168 @@
+"""
+Time the stages of reading a run on synthetic run folders of 1k, 10k and 100k FastQs (see bench.runfolder): discovery
+(PatientHelper._scan, on a warm cache), the whole of PatientHelper._read, classification (RegexHelper.update), sorting
+and validation, and JsonBuilder.build_json. Results are saved as json named after the commit, so runs of two commits
+can be compared with --compare.
+
+    python3 -m bench.suite [--sizes 1000 10000 100000] [--layouts illumina custom] [-o FILE] [--compare OLD.json]
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import load_adegen
+from bench.runfolder import generate
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+STAGES = ["discover", "read", "classify", "sort_validate", "build_json"]
+
+
+def measure(func, setup=None, repeat=3):
+    """
+    :param func: callable taking the result of setup, or nothing
+    :param setup: callable run untimed before each call of func (optional)
+    :param repeat:
+    :return: (fastest wall time in seconds, result of the last call)
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        args = (setup(),) if setup else ()
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def git_commit():
+    """
+    :return: (commit hash, whether the tree has changes), or (None, None) outside a git checkout
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True, check=True)
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root,
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.stdout.strip(), status.stdout.strip() != ""
+
+
+def run_stages(adegen, run, repeat):
+    """
+    :param adegen:
+    :param run: return value of runfolder.generate
+    :param repeat:
+    :return: dict of {stage: seconds}
+    """
+    root, regex_file = run["root"], run["regex_file"]
+    helper = adegen.RegexHelper(regex_file)
+    times = dict()
+
+    times["discover"], files = measure(lambda: list(adegen.PatientHelper._scan(root, True)), repeat=repeat)
+    times["read"], read = measure(lambda: adegen.PatientHelper._read(root, True, regex_file), repeat=repeat)
+
+    def _classify():
+        patients = dict()
+        for file in files:
+            helper.update(file, patients)
+        return patients
+
+    times["classify"], patients = measure(_classify, repeat=repeat)
+    assert sum(map(len, patients.values())) == run["samples"], "not every sample was found"
+    assert sum(map(len, read.values())) == run["samples"], "_read and RegexHelper.update disagree"
+
+    def _sort_validate(classified):
+        sorted_patients = adegen.PatientHelper._sort_patients(classified)
+        assert adegen.PatientHelper.is_valid(sorted_patients), "synthetic run is invalid"
+        return sorted_patients
+
+    times["sort_validate"], patients = measure(_sort_validate, _classify, repeat)
+
+    ids = {p_ref: (_i, _i) for _i, p_ref in enumerate(patients)}
+    times["build_json"], _ = measure(lambda: adegen.JsonBuilder.build_json("run", 1, 2, 1, 3, patients, ids, 108000),
+                                     repeat=repeat)
+    return times
+
+
+def compare(results, old_file):
+    """
+    Print the time of each stage against the same stage in old_file
+    :param results:
+    :param old_file:
+    :return:
+    """
+    with open(old_file) as f_in:
+        old = json.load(f_in)
+    before = {(_r["layout"], _r["files"], _r["stage"]): _r["seconds"] for _r in old["results"]}
+    print(f"Against {old_file} ({(old['commit'] or 'unknown')[:10]})")
+    for result in results:
+        key = (result["layout"], result["files"], result["stage"])
+        if key in before:
+            print(f"{key[0]:9} {key[1]:>8} {key[2]:14} {before[key]:9.4f}s -> {result['seconds']:9.4f}s  "
+                  f"x{before[key] / max(result['seconds'], 1e-9):.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--layouts", nargs="+", choices=["illumina", "custom"], default=["illumina", "custom"])
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--noise", type=float, default=0.1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tmp", help="Folder to generate the runs in (defaults to the system temp folder)")
+    parser.add_argument("-o", "--output", help="Results file (defaults to bench/results/<commit>.json)")
+    parser.add_argument("--compare", metavar="OLD", help="Results file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    adegen = load_adegen()
+    commit, dirty = git_commit()
+
+    results = []
+    print(f"{'layout':9} {'files':>8} " + " ".join(f"{_s:>14}" for _s in STAGES))
+    for layout in args.layouts:
+        for size in args.sizes:
+            with tempfile.TemporaryDirectory(dir=args.tmp) as tmp:
+                run = generate(os.path.join(tmp, "run"), size, noise=args.noise, depth=args.depth, layout=layout)
+                # Skipped files and counts are printed, keep them out of the report
+                with contextlib.redirect_stdout(io.StringIO()):
+                    times = run_stages(adegen, run, args.repeat)
+            print(f"{layout:9} {run['fastq']:8} " + " ".join(f"{times[_s]:13.4f}s" for _s in STAGES))
+            results += [{"layout": layout, "files": run["fastq"], "samples": run["samples"], "noise": run["noise"],
+                         "stage": _s, "seconds": round(times[_s], 6),
+                         "us_per_file": round(times[_s] / run["fastq"] * 1e6, 3)} for _s in STAGES]
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{(commit or 'unknown')[:10]}{'-dirty' if dirty else ''}.json")
+    with open(output, "w") as f_out:
+        json.dump({
+            "commit": commit,
+            "dirty": dirty,
+            "time": datetime.datetime.now().astimezone().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+            "results": results,
+        }, f_out, indent=3)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Serial against process pool classification in PatientHelper._get_patient_data, to find the number of files
+from which --workers pays off.
+
+    python3 -m bench.workers_bench [--workers 4] [--sizes 1000 10000 100000 500000]
+"""
+
+import argparse
+import contextlib
+import io
+
+from bench import best_of, load_adegen
+from bench.regex_bench import synthetic_names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000, 100000, 500000])
+    args = parser.parse_args()
+
+    adegen = load_adegen()
+
+    def _classify(names, workers):
+        # Skipped files are printed, keep them out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            return adegen.PatientHelper._get_patient_data(names, None, None, workers)
+
+    print(f"{'files':>8} {'serial':>10} " + " ".join(f"{f'{_w} workers':>12}" for _w in args.workers))
+    for size in args.sizes:
+        names = synthetic_names(size)
+        serial, expected = best_of(lambda: _classify(names, 1))
+        row = f"{size:8} {serial:9.3f}s"
+        for workers in args.workers:
+            elapsed, result = best_of(lambda: _classify(names, workers))
+            assert result == expected, f"{workers} workers disagree with the serial result"
+            row += f" {elapsed:8.3f}s {'+' if elapsed < serial else '-'}  "
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
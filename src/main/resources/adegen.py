@@ -1,4 +1,8 @@
 import argparse
+import concurrent.futures
+import contextlib
+import fnmatch
+import itertools
 import os
 import time
 import datetime
@@ -7,77 +11,364 @@ import subprocess
 import pathlib
 import re
 import getpass
+import gzip
+import sys
+import hashlib
+import io
+import tempfile
+import threading
+import zlib
+
+try:
+    import resource
+except ImportError:
+    # Windows: no peak RSS or child CPU in --timings
+    resource = None
 
 debug = False
 
+# RegexHelper of a process pool worker, see PatientHelper._init_worker
+_worker_regex_helper = None
+
+# Only files with these endings can match RegexHelper.ILLUMINA_RE, so with it the others are never classified
+FASTQ_SUFFIXES = (".fastq.gz", ".fq.gz")
+
+
+class Sample(list):
+    """
+    A sample of a patient: the list of its FastQ files, with its id and tag. Subclassing list saves an object per
+    sample, which adds up with tens of thousands of samples
+    """
+
+    __slots__ = ("sample_id", "tag")
+
+    @staticmethod
+    def create(sample_id, tag, files):
+        # Without an __init__ of its own, the list is built in C
+        sample = Sample(files)
+        sample.sample_id = sample_id
+        sample.tag = tag
+        return sample
+
+
+class Patient(list):
+    """
+    The list of a patient's samples, with the sorted tuple of their tags and the topology type they make. Both are
+    kept up to date as samples are added, so is_valid and JsonBuilder don't need to work them out again
+    """
+
+    __slots__ = ("tags", "topology")
+
+    # Tag pairs that make a topology; the type is that of the first tag in JsonBuilder.top_type
+    TOPOLOGY_PAIRS = (("D", "R"), ("N", "T"))
+
+    # (tags, added tag) -> (new tags, topology), so each combination is only sorted and looked up once
+    _tag_transitions = dict()
+
+    def __init__(self):
+        # list.__new__ already made the empty list, calling list.__init__ too only costs time
+        self.tags = ()
+        self.topology = None
+
+    def add(self, sample_id, tag, file):
+        """
+        Add a file to the sample, creating the sample if it's new
+        :param sample_id:
+        :param tag:
+        :param file:
+        :return:
+        """
+        for sample in self:
+            if sample.sample_id == sample_id:
+                sample.append(file)
+                return
+        self.append(Sample.create(sample_id, tag, (file,)))
+        self._add_tag(tag)
+
+    def merge(self, other):
+        """
+        Add the samples and files of other, as if its files had been added one by one
+        :param other: Patient
+        :return:
+        """
+        for other_sample in other:
+            sample = self.find(other_sample.sample_id)
+            if sample is None:
+                self.append(other_sample)
+                self._add_tag(other_sample.tag)
+            else:
+                sample.extend(other_sample)
+
+    def find(self, sample_id):
+        """
+        :param sample_id:
+        :return: the Sample, or None. A patient has one or two samples so a scan beats a dict
+        """
+        for sample in self:
+            if sample.sample_id == sample_id:
+                return sample
+        return None
+
+    def _add_tag(self, tag):
+        transition = Patient._tag_transitions.get((self.tags, tag))
+        if transition is None:
+            tags = tuple(sorted(self.tags + (tag,)))
+            transition = (tags, JsonBuilder.top_type[tags[0]] if tags in Patient.TOPOLOGY_PAIRS else None)
+            Patient._tag_transitions[(self.tags, tag)] = transition
+        self.tags, self.topology = transition
+
+    def to_dict(self):
+        """
+        :return: dict of {sample_id: [tag, file1, file2], . . . }, for messages
+        """
+        return {_sample.sample_id: [_sample.tag] + _sample for _sample in self}
+
 
 class PatientHelper:
-    ONE_PATIENT_RE = r"{\"medicalInformationId\":\d+,\"personalInformationId\":\d+,\"userRef\":\".+\"}"
-    ALL_PATIENTS_RE = rf"(\[{ONE_PATIENT_RE}(,{ONE_PATIENT_RE})*\])"
+    # Keys identifying a patient object in the output of `patient -l`
+    PATIENT_KEYS = ("medicalInformationId", "personalInformationId", "userRef")
+    OBJECT_ARRAY_RE = re.compile(r"\[\s*\{")
 
     MAX_P_REF_LENGTH = 30
 
+    # Patient refs per create/list call and how often a failed batch is tried again
+    BATCH_SIZE = 50
+    BATCH_RETRIES = 2
+
+    # Number of files classified per task
+    CLASSIFY_CHUNK = 5000
+
+    # Folders that never hold FastQ files in an Illumina run folder
+    EXCLUDE_DIRS = ["Thumbnail_Images", "InterOp", "L00*", "Logs"]
+
     @staticmethod
-    def read(path, recurse, regex_file):
+    def read(path, recurse, regex_file, excludes=None, index_file=None, workers=1, settle=None):
         """
         :param path: Folder of fastq files
         :param recurse:
         :param regex_file:
-        :return: dict of {patient_ref_01: {sample_id_01: [tag, file1, file2], sample_id_02: [tag, file1, file2]}, . . .}
+        :param excludes: glob patterns of folder names to skip when recursing (defaults to EXCLUDE_DIRS)
+        :param index_file: scan index caching the classification of unchanged files between runs (optional)
+        :param workers: number of processes classifying the files
+        :param settle: if given, leave out the patients with a file that changed in the last settle seconds or isn't
+                       a complete gzip
+        :return: dict of {patient_ref_01: Patient, . . .}, ordered by the patients' first sample ids
         """
 
         print("Reading FastQ folder")
+        timing = Timings.start("read")
 
         if os.path.exists(path):
-            patient_data = PatientHelper._sort_patients(PatientHelper._read(path, recurse, regex_file))
+            patient_data = PatientHelper._sort_patients(PatientHelper._read(path, recurse, regex_file, excludes,
+                                                                                  index_file, workers, settle))
         else:
             print(f"Error: Couldn't find {path}")
             patient_data = None
 
+        Timings.stop(timing, folder=path, patients=len(patient_data) if patient_data else 0)
         return patient_data
 
     @staticmethod
-    def _read(path, recurse, regex_file):
+    def _read(path, recurse, regex_file, excludes=None, index_file=None, workers=1, settle=None):
         """
         Get the patient info of fastq files in path. If recurse is True, recurse to subfolders
         :param path:
         :param recurse:
         :param regex_file:
+        :param excludes:
+        :param index_file:
+        :param workers:
+        :param settle:
         :return:
         """
 
-        # Check sub folders if recursion is set
-        if recurse:
-            fastq_files = list(pathlib.Path(path).rglob("*"))
-        else:
-            fastq_files = list(pathlib.Path(path).glob("*"))
+        fastq_files = Timings.iterate("scan", PatientHelper._scan(path, recurse, excludes,
+                                                                  PatientHelper.scan_suffixes(regex_file)))
+        deferred = dict()
+        if settle is not None:
+            complete, deferred = VerifyHelper.complete_files(fastq_files, settle)
+            fastq_files = iter(complete)
 
-        if len(fastq_files) == 0:
+        # Peek at the first file so an empty folder is reported without building a list
+        first = next(fastq_files, None)
+        if first is None:
             print("Error: no files found")
             patient_data = None
         else:
-            print(f"Found {len(fastq_files)} files")
-            patient_data = PatientHelper._get_patient_data(fastq_files, regex_file)
+            patient_data = PatientHelper._get_patient_data(itertools.chain([first], fastq_files), regex_file,
+                                                           index_file, workers)
+            if deferred:
+                PatientHelper._drop_deferred(patient_data, deferred, regex_file)
 
         return patient_data
 
     @staticmethod
-    def _get_patient_data(filenames, regex_override=None):
+    def _drop_deferred(patient_data, deferred, regex_file):
+        """
+        Leave out every patient with a deferred file: a sample missing one of its reads or lanes can't be uploaded,
+        and the other samples of the patient wait for it so a pair is never uploaded half
+        :param patient_data: dict of {patient_ref: Patient, . . . }, changed in place
+        :param deferred: dict of {file: reason}
+        :param regex_file:
+        :return:
+        """
+        regex_helper = RegexHelper(regex_file)
+        for file in deferred:
+            match = regex_helper.match(file)
+            if match and match[0] in patient_data:
+                del patient_data[match[0]]
+                print(f"Deferring patient {match[0]}: {file} isn't complete")
+
+    @staticmethod
+    def scan_suffixes(regex_file):
+        """
+        :param regex_file:
+        :return: FASTQ_SUFFIXES with the Illumina regex, or None if regex_file may match any file name
+        """
+        return FASTQ_SUFFIXES if regex_file is None else None
+
+    @staticmethod
+    def _scan(path, recurse, excludes=None, suffixes=FASTQ_SUFFIXES):
+        """
+        Lazily yield the fastq files in path using os.scandir. Folders matching one of the exclude globs are pruned
+        before they are entered, and only files ending in one of suffixes are yielded
+        :param path:
+        :param recurse:
+        :param excludes: glob patterns matched against folder names (defaults to EXCLUDE_DIRS)
+        :param suffixes: None to yield every file
+        :return: generator of file paths
+        """
+
+        if excludes is None:
+            excludes = PatientHelper.EXCLUDE_DIRS
+
+        # Same root as pathlib would report, so file names in the ADE don't change
+        pending = [str(pathlib.Path(path))]
+        while pending:
+            folder = pending.pop()
+            sub_folders = []
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        try:
+                            # Like rglob, never follow links to folders so cycles are impossible
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                        except OSError:
+                            continue
+
+                        if is_dir:
+                            if recurse and not any(fnmatch.fnmatch(entry.name, _ex) for _ex in excludes):
+                                sub_folders.append(entry.path)
+                        elif suffixes is None or entry.name.endswith(suffixes):
+                            yield entry.path
+            except OSError as err:
+                print(f"Skipping {folder}: {err}")
+
+            # Keep a depth first, top-down order
+            pending.extend(reversed(sub_folders))
+
+    @staticmethod
+    def _get_patient_data(filenames, regex_override=None, index_file=None, workers=1):
         """
-        :param filenames: list of fastq filenames
-        :return: dict of {patient_ref: sample_id1: [tag, file1, file2], sample_id2: [tag, file1, file2], . . . }
+        Classify the files in chunks, in this process or, if workers > 1, in a process pool. Each chunk gives a
+        partial patients dict which is merged in chunk order, so the result doesn't depend on workers
+        :param filenames: iterable of fastq filenames
+        :param regex_override:
+        :param index_file: scan index to reuse and update (optional)
+        :param workers: number of processes classifying the files
+        :return: dict of {patient_ref: Patient, . . . }
         """
 
+        timing = Timings.start("classify")
         patients = dict()
         regex_helper = RegexHelper(regex_override)
-        for file in filenames:
-            file = str(file)
-            updated = regex_helper.update(file, patients)
-            if not updated:
-                print(f"Skipping {file}")
+        index = ScanIndex(index_file, regex_helper.signature()) if index_file else None
+        found = 0
+
+        def _chunks():
+            nonlocal found
+            files = iter(filenames)
+            while True:
+                # False marks a file that still has to be parsed, as None is a cached "no match"
+                chunk = [(str(_f), index.lookup(str(_f)) if index else False)
+                         for _f in itertools.islice(files, PatientHelper.CLASSIFY_CHUNK)]
+                if len(chunk) == 0:
+                    return
+                found += len(chunk)
+                yield chunk
+
+        if workers > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=PatientHelper._init_worker,
+                                                              initargs=(regex_helper,))
+            results = executor.map(PatientHelper._classify_chunk, _chunks())
+        else:
+            executor = None
+            results = (PatientHelper._classify_chunk(_chunk, regex_helper) for _chunk in _chunks())
 
+        try:
+            for partial, skipped, parsed in results:
+                PatientHelper._merge_patients(patients, partial)
+                for file in skipped:
+                    print(f"Skipping {file}")
+                if index is not None:
+                    for file, match in parsed:
+                        index.store(file, match)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        print(f"Found {found} files")
+
+        if index is not None:
+            print(f"Scan index: {index.cached} files from cache, {index.parsed} parsed")
+            index.save()
+
+        Timings.stop(timing, files=found, workers=workers)
         return patients
 
+    @staticmethod
+    def _init_worker(regex_helper):
+        global _worker_regex_helper
+        _worker_regex_helper = regex_helper
+
+    @staticmethod
+    def _classify_chunk(chunk, regex_helper=None):
+        """
+        :param chunk: list of (file, match) where match is False if the file hasn't been classified yet
+        :param regex_helper: defaults to the one given to the worker process
+        :return: (partial patients dict, skipped files, list of (file, match) classified here)
+        """
+        if regex_helper is None:
+            regex_helper = _worker_regex_helper
+
+        patients = dict()
+        skipped = []
+        parsed = []
+        for file, match in chunk:
+            if match is False:
+                match = regex_helper.match(file)
+                parsed.append((file, match))
+
+            if match:
+                PatientHelper.update_patient(patients, *match, file)
+            else:
+                skipped.append(file)
+
+        return patients, skipped, parsed
+
+    @staticmethod
+    def _merge_patients(patients, partial):
+        """
+        Merge a partial patients dict into patients, as if its files had been added one by one
+        :param patients:
+        :param partial:
+        :return:
+        """
+        for p_ref, patient in partial.items():
+            if p_ref in patients:
+                patients[p_ref].merge(patient)
+            else:
+                patients[p_ref] = patient
+
     @staticmethod
     def update_patient(patients, p_ref, s_id, tag, file):
         """
@@ -89,18 +380,15 @@ class PatientHelper:
         :param tag:
         :return:
         """
-        if p_ref in patients:
-            if s_id in patients[p_ref]:
-                patients[p_ref][s_id].append(file)
-            else:
-                patients[p_ref][s_id] = [tag, file]
-        else:
-            patients[p_ref] = {s_id: [tag, file]}
+        patient = patients.get(p_ref)
+        if patient is None:
+            patient = patients[p_ref] = Patient()
+        patient.add(s_id, tag, file)
 
     @staticmethod
     def _sort_patients(patients):
         """
-        Return a copy of patients with the samples in sorted order
+        Sort the samples of each patient by id, in place, and return patients ordered by their first sample id
         :param patients:
         :return:
         """
@@ -108,36 +396,76 @@ class PatientHelper:
         if patients is None:
             return None
 
-        ids2p_ref = dict()
-        for p_ref, samples in patients.items():
-            for _id in samples.keys():
-                ids2p_ref[_id] = p_ref
-        sorted_ids = list(ids2p_ref.keys())
-        sorted_ids.sort()
-
-        sorted_patients = dict()
-        for _id in sorted_ids:
-            p_ref = ids2p_ref[_id]
-            if p_ref in sorted_patients:
-                sorted_patients[p_ref][_id] = patients[p_ref][_id]
-            else:
-                sorted_patients[p_ref] = {_id: patients[p_ref][_id]}
+        for patient in patients.values():
+            patient.sort(key=lambda _sample: _sample.sample_id)
 
-        return sorted_patients
+        return dict(sorted(patients.items(), key=lambda _item: _item[1][0].sample_id))
 
     @staticmethod
-    def create_patients(command, patient_data, client_id):
+    def create_patients(command, patient_data, client_id, batch_size=None, batch_workers=1):
         """
+        Create and list the patients in batches of batch_size, so the command line stays well below the OS limits.
+        A failed batch is retried on its own up to BATCH_RETRIES times
         :param command:
         :param patient_data:
         :param client_id:
+        :param batch_size: patient refs per batch (defaults to BATCH_SIZE)
+        :param batch_workers: number of batches run at the same time (ignored with client_id, which prompts)
         :return: dict of {patient_ref: (personalInformationId, medicalInformationId), . . . }
         """
 
-        patient_refs = "--patient-ref=" + ",".join(patient_data.keys())
+        if batch_size is None:
+            batch_size = PatientHelper.BATCH_SIZE
+        p_refs = list(patient_data.keys())
+        batches = [p_refs[_i:_i + batch_size] for _i in range(0, len(p_refs), batch_size)]
+        if client_id:
+            batch_workers = 1
+
+        ids = dict()
+        pending = list(range(len(batches)))
+        for attempt in range(PatientHelper.BATCH_RETRIES + 1):
+            if attempt > 0:
+                print(f"Retrying {len(pending)} failed batch{'es' if len(pending) > 1 else ''}")
+
+            def _run(_b):
+                return PatientHelper._create_batch(command, batches[_b], client_id, _b + 1, len(batches))
+
+            if batch_workers > 1 and len(pending) > 1:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=batch_workers) as executor:
+                    results = list(executor.map(_run, pending))
+            else:
+                results = [_run(_b) for _b in pending]
+
+            failed = []
+            for _b, batch_ids in zip(pending, results):
+                if batch_ids is None:
+                    failed.append(_b)
+                else:
+                    ids.update(batch_ids)
+            pending = failed
+            if len(pending) == 0:
+                return ids
+
+        print(f"Error: couldn't create patients {', '.join(p for _b in pending for p in batches[_b])}")
+        return None
+
+    @staticmethod
+    def _create_batch(command, p_refs, client_id, number, total):
+        """
+        Create and list one batch of patients
+        :param command:
+        :param p_refs:
+        :param client_id:
+        :param number: position of the batch, for messages
+        :param total: number of batches, for messages
+        :return: dict of {patient_ref: (personalInformationId, medicalInformationId), . . . } or None
+        """
+
+        patient_refs = "--patient-ref=" + ",".join(p_refs)
+        batch = f" (batch {number}/{total})" if total > 1 else ""
 
         # Build the create command
-        print("Creating patients")
+        print(f"Creating patients{batch}")
         create_command = command[:] + ["patient", "-c", patient_refs]
 
         if client_id:
@@ -148,7 +476,7 @@ class PatientHelper:
             Logger.log(result_create)
 
         # Build the list command
-        print("Listing patients")
+        print(f"Listing patients{batch}")
         list_command = command[:] + ["patient", "-l", patient_refs]
 
         if client_id:
@@ -158,32 +486,83 @@ class PatientHelper:
             stdout_list = result_list.stdout
             Logger.log(result_list)
 
-        return PatientHelper._extract_patients(stdout_list)
+        ids = PatientHelper._extract_patients(stdout_list)
+        if ids is not None:
+            missing = [p for p in p_refs if p not in ids]
+            if len(missing) > 0:
+                print(f"Error: patient list{batch} is missing {', '.join(missing)}")
+                return None
+        return ids
 
     @staticmethod
     def _extract_patients(stdout):
         # dict of IDs to return
         ids = None
 
-        # Find the returned patient list and convert to Json
-        patient_list = re.search(PatientHelper.ALL_PATIENTS_RE, stdout)
+        # Find the returned patient list
+        patient_list = PatientHelper._find_patient_list(stdout)
         if patient_list:
-            try:
-                print("Parsing IDs")
-                result_json = json.loads(patient_list.groups()[0])
-                ids = dict()
-                for patient in result_json:
-                    patient_ref = patient['userRef']
-                    per_id = patient['personalInformationId']
-                    med_id = patient['medicalInformationId']
-                    ids[patient_ref] = (per_id, med_id)
-            except json.decoder.JSONDecodeError:
-                print("Error: couldn't decode patient IDs")
+            print("Parsing IDs")
+            ids = dict()
+            for patient in patient_list:
+                patient_ref = patient['userRef']
+                per_id = patient['personalInformationId']
+                med_id = patient['medicalInformationId']
+                ids[patient_ref] = (per_id, med_id)
         else:
             print("Error: couldn't find patient list in stdout")
 
         return ids
 
+    @staticmethod
+    def _find_patient_list(stdout):
+        """
+        Decode json with raw_decode from each "[" in stdout that opens an array of objects, and return the first array
+        of patient objects. Other brackets (e.g. "[main] INFO" log prefixes) are never decoded, as every decode error
+        costs a pass over the output to find its line number, and values that decode but aren't patient lists are
+        skipped as a whole, so the scan stays linear in the output size.
+        Without such an array, patient objects printed one per line are collected instead
+        :param stdout:
+        :return: list of patient dicts, or None
+        """
+
+        def _is_patient(_value):
+            return isinstance(_value, dict) and all(_k in _value for _k in PatientHelper.PATIENT_KEYS)
+
+        decoder = json.JSONDecoder()
+        candidate = PatientHelper.OBJECT_ARRAY_RE.search(stdout)
+        while candidate:
+            try:
+                value, end = decoder.raw_decode(stdout, candidate.start())
+            except json.decoder.JSONDecodeError:
+                candidate = PatientHelper.OBJECT_ARRAY_RE.search(stdout, candidate.start() + 1)
+                continue
+
+            if isinstance(value, list) and all(_is_patient(_v) for _v in value):
+                return value
+            candidate = PatientHelper.OBJECT_ARRAY_RE.search(stdout, end)
+
+        patients = []
+        for line in stdout.splitlines():
+            line = line.strip()
+            if line.startswith("{"):
+                try:
+                    value = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    continue
+                if _is_patient(value):
+                    patients.append(value)
+
+        return patients if len(patients) > 0 else None
+
+    @staticmethod
+    def list_files(patient_data):
+        """
+        :param patient_data:
+        :return: list of all files in patient_data, in ADE order
+        """
+        return [file for patient in patient_data.values() for sample in patient for file in sample]
+
     @staticmethod
     def is_valid(patient_data):
         """
@@ -192,28 +571,24 @@ class PatientHelper:
         :return:
         """
 
-        def _is_mys(_tags):
-            return "D" in _tags and "R" in _tags
-
-        def _is_tumornormal(_tags):
-            return "N" in _tags and "T" in _tags
-
         _valid = True
 
-        for p_ref, samples in patient_data.items():
+        for p_ref, patient in patient_data.items():
             probs = []
 
             # Check length of p_ref
             if len(p_ref) > PatientHelper.MAX_P_REF_LENGTH:
                 probs.append(f"Patient refs can be no longer than {PatientHelper.MAX_P_REF_LENGTH} characters")
 
-            tags = [samples[s_id][0] for s_id in samples.keys()]
-            num_samples = len(samples)
+            tags = patient.tags
+            num_samples = len(tags)
             if num_samples == 2:
                 # Should be DNA/RNA, Normal/Tumour, or unspecified
-                if not _is_mys(tags) and not _is_tumornormal(tags) and tags != ["", ""]:
+                if patient.topology is None and tags != ("", ""):
                     probs.append("Patients with two samples should have D and R (mys), T and N (tumorNormal), or none")
-                    probs[-1] += f" - found <{tags[0]}> and <{tags[1]}>"
+                    # patient.tags is sorted, the message lists the tags in sample order
+                    first, second = patient
+                    probs[-1] += f" - found <{first.tag}> and <{second.tag}>"
             elif num_samples == 1:
                 # One sample should have D, R, or no tag
                 if tags[0] not in ["", "D", "R"]:
@@ -227,12 +602,686 @@ class PatientHelper:
                 print(f"Error{'s' if len(probs) > 1 else ''} for patient ref {p_ref}")
                 for p in probs:
                     print(p)
-                print(json.dumps(patient_data[p_ref], indent=3))
+                print(json.dumps(patient.to_dict(), indent=3))
 
         return _valid
 
 
+class ScanIndex:
+    """
+    On-disk cache of RegexHelper results, one json line per file keyed by path, size, mtime and inode.
+    The first line records the regex signature; the whole index is discarded when the expressions change
+    """
+
+    VERSION = 1
+
+    def __init__(self, filename, signature):
+        self.filename = filename
+        self.signature = signature
+        self.entries = dict()
+        self.seen = dict()
+        self.pending = dict()
+        self.cached = 0
+        self.parsed = 0
+        self.load()
+
+    @staticmethod
+    def default_path(folder):
+        """
+        Index file kept next to the run folder, so the folder itself is never written to
+        :param folder:
+        :return:
+        """
+        folder = pathlib.Path(folder).resolve()
+        return str(folder.parent / f".{folder.name}.adegen-index.jsonl")
+
+    def load(self):
+        try:
+            with open(self.filename, "r") as file_in:
+                header = json.loads(file_in.readline())
+                if header.get("version") != ScanIndex.VERSION or header.get("signature") != self.signature:
+                    print("Scan index is outdated, rebuilding")
+                    return
+                for line in file_in:
+                    entry = json.loads(line)
+                    self.entries[entry["path"]] = entry
+        except FileNotFoundError:
+            pass
+        except (json.decoder.JSONDecodeError, KeyError, AttributeError):
+            print(f"Warning: ignoring unreadable scan index {self.filename}")
+            self.entries = dict()
+
+    def lookup(self, filename):
+        """
+        :param filename:
+        :return: the cached (p_ref, sample_id, tag) or None if filename is unchanged, otherwise False
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+
+        key = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "inode": stat.st_ino}
+        entry = self.entries.get(filename)
+        if entry is None or any(entry.get(k) != v for k, v in key.items()):
+            self.pending[filename] = key
+            return False
+
+        # Only files seen in this scan are kept, so deleted files drop out of the index
+        self.seen[filename] = entry
+        self.cached += 1
+        return tuple(entry["match"]) if entry["match"] is not None else None
+
+    def store(self, filename, match):
+        """
+        Record the freshly parsed match of a file that lookup() didn't find
+        :param filename:
+        :param match:
+        :return:
+        """
+        self.parsed += 1
+        key = self.pending.pop(filename, None)
+        if key is not None:
+            self.seen[filename] = dict(path=filename, match=match, **key)
+
+    def save(self):
+        lines = [json.dumps({"version": ScanIndex.VERSION, "signature": self.signature})]
+        lines += [json.dumps(entry) for entry in self.seen.values()]
+        try:
+            atomic_write(self.filename, "\n".join(lines) + "\n")
+        except OSError as err:
+            print(f"Warning: couldn't write scan index {self.filename}: {err}")
+
+
+class FileResultCache:
+    """
+    Results computed from a file's content, kept in a json file by path and only reused while the file's size and
+    mtime are unchanged. Like ScanIndex, only the files of the last run are kept, so the file doesn't grow with every
+    run and deleted or changed files drop out
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename, "r") as file_in:
+                self.entries = json.load(file_in)
+            if not isinstance(self.entries, dict):
+                self.entries = dict()
+        except (OSError, ValueError):
+            self.entries = dict()
+        # Entries reused or computed in this run, the only ones saved
+        self.seen = dict()
+
+    @staticmethod
+    def key(path):
+        """
+        :param path:
+        :return: (size, mtime_ns) of the file
+        """
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def get(self, path):
+        """
+        :param path:
+        :return: the cached result, or None if there is none or the file has changed
+        """
+        entry = self.entries.get(path)
+        try:
+            if entry is not None and (entry["size"], entry["mtime"]) == FileResultCache.key(path):
+                self.seen[path] = entry
+                return entry["result"]
+        except (OSError, KeyError, TypeError):
+            pass
+        return None
+
+    def put(self, path, key, result):
+        """
+        :param path:
+        :param key: (size, mtime_ns) of the file when the result was computed
+        :param result:
+        :return:
+        """
+        self.entries[path] = self.seen[path] = {"size": key[0], "mtime": key[1], "result": result}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            atomic_write(self.filename, json.dumps(self.seen))
+        except OSError as err:
+            print(f"Warning: couldn't write {self.filename}: {err}")
+
+
+class VerifyHelper:
+    """
+    Checks that FastQ files are complete before anything is created for them: every gzip member decompresses and
+    matches its CRC/ISIZE trailer, and the content is made of 4-line records with equal sequence and quality lengths
+    """
+
+    # Decompressed bytes read at a time
+    CHUNK_SIZE = 4 * 1024 * 1024
+
+    # Empty block ending a BGZF file
+    BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+    # How far back from the end the last gzip member is looked for; a BGZF block is at most 64 KiB
+    TAIL_SIZE = 64 * 1024
+
+    @staticmethod
+    def default_cache():
+        return os.path.join(cache_dir(), "verify.json")
+
+    @staticmethod
+    def verify(patient_data, workers=1, cache_file=None):
+        """
+        Verify every file in patient_data, reusing results of unchanged files, and report the bad ones
+        :param patient_data:
+        :param workers: number of processes verifying files
+        :param cache_file: defaults to default_cache()
+        :return: whether all files are good
+        """
+
+        timing = Timings.start("verify")
+        files = PatientHelper.list_files(patient_data)
+        cache = FileResultCache(cache_file if cache_file else VerifyHelper.default_cache())
+
+        results = dict()
+        todo = []
+        for file in files:
+            cached = cache.get(file)
+            if cached is not None:
+                results[file] = cached
+            else:
+                todo.append(file)
+        print(f"Verifying {len(todo)} files ({len(files) - len(todo)} unchanged since last verified)")
+
+        start = time.perf_counter()
+        if workers > 1 and len(todo) > 1:
+            with concurrent.futures.ProcessPoolExecutor(min(workers, len(todo))) as executor:
+                verified = list(executor.map(VerifyHelper.verify_file, todo))
+        else:
+            verified = [VerifyHelper.verify_file(file) for file in todo]
+        elapsed = time.perf_counter() - start
+
+        for file, (key, result) in zip(todo, verified):
+            results[file] = result
+            if key is not None:
+                cache.put(file, key, result)
+        cache.save()
+
+        size = sum(key[0] for key, _ in verified if key is not None)
+        if len(todo) > 0:
+            print(f"Verified {size / 1e6:.0f} MB in {elapsed:.1f}s ({size / 1e6 / max(elapsed, 1e-9):.0f} MB/s)")
+
+        bad = {file for file in files if results[file]["error"] is not None}
+        for file in files:
+            if file in bad:
+                print(f"Error: {file}: {results[file]['error']}")
+        for file in files:
+            if debug and results[file]["error"] is None:
+                print(f"{file}: {results[file]['reads']} reads")
+        print(f"{len(files) - len(bad)} of {len(files)} files are complete "
+              f"({sum(results[file]['reads'] for file in files if file not in bad)} reads)")
+
+        Timings.stop(timing, files=len(files), verified=len(todo), bytes=size)
+        return len(bad) == 0
+
+    @staticmethod
+    def verify_file(path):
+        """
+        :param path:
+        :return: ((size, mtime_ns) before reading, or None if the result shouldn't be cached,
+                  {"reads": number of good reads, "error": None or a message})
+        """
+        try:
+            key = FileResultCache.key(path)
+        except OSError as err:
+            return None, {"reads": 0, "error": str(err)}
+
+        reads = 0
+        pending = b""
+        try:
+            with gzip.open(path, "rb") as gz:
+                for chunk in iter(lambda: gz.read(VerifyHelper.CHUNK_SIZE), b""):
+                    lines = (pending + chunk).split(b"\n")
+                    # Only whole records are checked, the rest waits for the next chunk
+                    complete = (len(lines) - 1) // 4 * 4
+                    error = VerifyHelper._check_records(lines[:complete], reads)
+                    if error:
+                        return key, {"reads": reads, "error": error}
+                    reads += complete // 4
+                    pending = b"\n".join(lines[complete:])
+        except (OSError, EOFError, zlib.error) as err:
+            # e.g. "Compressed file ended before the end-of-stream marker was reached" or a CRC check failure
+            return key, {"reads": reads, "error": f"gzip: {err}"}
+
+        # A last record without a final newline
+        if pending:
+            lines = pending.split(b"\n")
+            error = VerifyHelper._check_records(lines, reads) if len(lines) == 4 else \
+                f"truncated record after read {reads}"
+            if error:
+                return key, {"reads": reads, "error": error}
+            reads += 1
+
+        try:
+            if FileResultCache.key(path) != key:
+                return None, {"reads": reads, "error": "file changed while it was verified"}
+        except OSError as err:
+            return None, {"reads": reads, "error": str(err)}
+
+        return key, {"reads": reads, "error": None}
+
+    @staticmethod
+    def complete_files(files, settle):
+        """
+        Cheap check of files that may still be written to: a file is only complete if its size and mtime haven't
+        changed for settle seconds and it ends with a BGZF EOF block or a whole gzip member (see check_tail).
+        Waits once, for at most settle seconds, if any file changed recently
+        :param files: iterable of file paths
+        :param settle: seconds
+        :return: (list of the complete files in the given order, dict of {file: reason} of the deferred ones)
+        """
+
+        keys = dict()
+        deferred = dict()
+        for file in files:
+            try:
+                keys[file] = FileResultCache.key(file)
+            except OSError as err:
+                deferred[file] = str(err)
+
+        if len(keys) > 0:
+            newest = max(_key[1] for _key in keys.values()) / 1e9
+            # An mtime in the future (clock skew, e.g. on a network share) mustn't make the wait longer than settle
+            wait = min(newest + settle - time.time(), settle)
+            if wait > 0:
+                print(f"Waiting {wait:.0f}s for recently changed files to settle")
+                time.sleep(wait)
+
+        complete = []
+        for file, key in keys.items():
+            try:
+                if FileResultCache.key(file) != key:
+                    deferred[file] = "still being written"
+                    continue
+                is_complete, reason = VerifyHelper.check_tail(file)
+            except OSError as err:
+                is_complete, reason = False, str(err)
+            if is_complete is False:
+                deferred[file] = reason
+            else:
+                if debug and reason:
+                    print(f"{file}: {reason}")
+                complete.append(file)
+
+        for file, reason in deferred.items():
+            print(f"Deferring {file}: {reason}")
+
+        return complete, deferred
+
+    @staticmethod
+    def check_tail(path):
+        """
+        Read only the end of a gzip file to see if it was written to the end: it must end with the BGZF EOF block or
+        with a gzip member that decompresses with a matching CRC and length, ending exactly at the end of the file
+        :param path:
+        :return: (True, None), (False, reason), or (None, reason) if the file isn't named .gz or the last member starts
+                 before the last TAIL_SIZE bytes, and it can't be checked this way
+        """
+
+        if not path.lower().endswith(".gz"):
+            # e.g. uncompressed FastQs matched by a -x regex file; only their size and mtime tell if they settled
+            return None, "not gzip compressed, not checked"
+
+        with open(path, "rb") as file_in:
+            if file_in.read(2) != b"\x1f\x8b":
+                return False, "not a gzip file"
+            size = file_in.seek(0, os.SEEK_END)
+
+            eof_size = len(VerifyHelper.BGZF_EOF)
+            if size >= eof_size:
+                file_in.seek(size - eof_size)
+                if file_in.read(eof_size) == VerifyHelper.BGZF_EOF:
+                    return True, None
+
+            start = max(0, size - VerifyHelper.TAIL_SIZE)
+            file_in.seek(start)
+            tail = file_in.read()
+
+        # Look for the last whole member: complete if it ends exactly at the end of the file, otherwise whatever
+        # follows it is a member that's cut short
+        pos = tail.rfind(b"\x1f\x8b\x08")
+        while pos >= 0:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            try:
+                decompressor.decompress(tail[pos:])
+                if decompressor.eof:
+                    if decompressor.unused_data:
+                        return False, "gzip ends mid-member"
+                    return True, None
+            except zlib.error:
+                pass
+            pos = tail.rfind(b"\x1f\x8b\x08", 0, pos)
+
+        if start == 0:
+            return False, "gzip ends mid-member"
+        return None, f"last gzip member starts before the last {VerifyHelper.TAIL_SIZE // 1024} KiB, not checked"
+
+    @staticmethod
+    def _check_records(lines, reads):
+        """
+        :param lines: whole 4-line records
+        :param reads: number of reads before these
+        :return: None, or a message about the first bad record
+        """
+        headers, sequences, separators, qualities = lines[0::4], lines[1::4], lines[2::4], lines[3::4]
+        if all(map(bytes.startswith, headers, itertools.repeat(b"@"))) \
+                and all(map(bytes.startswith, separators, itertools.repeat(b"+"))) \
+                and list(map(len, sequences)) == list(map(len, qualities)):
+            return None
+
+        for _i in range(len(headers)):
+            if not headers[_i].startswith(b"@"):
+                return f"read {reads + _i + 1}: header doesn't start with @"
+            if not separators[_i].startswith(b"+"):
+                return f"read {reads + _i + 1}: separator doesn't start with +"
+            if len(sequences[_i]) != len(qualities[_i]):
+                return f"read {reads + _i + 1}: sequence and quality lengths differ"
+        return None
+
+
+class RunWatcher:
+    """
+    Builds the patients dict while a run is being written. Each poll only lists the folder; files are classified
+    once, when their size and mtime are unchanged since the previous poll and their gzip looks complete, and only the
+    patients they belong to are validated again
+    """
+
+    # Files written by the sequencer once the run is complete
+    COMPLETION_MARKERS = ["CopyComplete.txt", "RTAComplete.txt"]
+    # How many folders up from the FastQ folder a marker is looked for (e.g. Data/Intensities/BaseCalls)
+    MARKER_DEPTH = 4
+
+    POLL_INTERVAL = 2
+
+    def __init__(self, path, recurse, regex_file, excludes=None, markers=None):
+        self.path = path
+        self.recurse = recurse
+        self.excludes = excludes
+        self.markers = markers if markers else RunWatcher.COMPLETION_MARKERS
+        self.regex_helper = RegexHelper(regex_file)
+        self.suffixes = PatientHelper.scan_suffixes(regex_file)
+        self.patients = dict()
+        self.invalid = set()
+        # Files seen but not classified yet, with their (size, mtime_ns), and files already classified or skipped
+        self.pending = dict()
+        self.done = set()
+        # Why pending files that haven't changed since the previous poll aren't complete
+        self.incomplete = dict()
+        self.last_change = time.time()
+        self.complete = False
+
+    def watch(self, quiet, interval=None, timeout=None):
+        """
+        Poll until a completion marker exists and nothing has changed for quiet seconds. Files that are still
+        incomplete then, e.g. a truncated gzip left by an aborted demultiplexing, are reported as deferred
+        :param quiet: seconds
+        :param interval: seconds between polls (defaults to POLL_INTERVAL)
+        :param timeout: seconds to wait for the run to complete (optional)
+        :return: the patients dict, sorted like PatientHelper.read. complete is only set if no file was deferred and
+                 the run completed in time
+        """
+
+        if interval is None:
+            interval = RunWatcher.POLL_INTERVAL
+        print(f"Watching {self.path} for FastQ files")
+
+        started = time.time()
+        marker = None
+        while True:
+            self.poll()
+            if marker is None:
+                marker = self.find_marker()
+                if marker is not None:
+                    print(f"Found {marker}, waiting until nothing has changed for {quiet}s")
+            if marker is not None and time.time() - self.last_change >= quiet:
+                break
+            if timeout is not None and time.time() - started >= timeout:
+                waiting_for = "changes to settle" if marker else f"{' or '.join(self.markers)}"
+                print(f"Error: run not complete after {timeout:.0f}s, still waiting for {waiting_for}")
+                break
+            time.sleep(interval)
+
+        for file in self.pending:
+            print(f"Deferring {file}: {self.incomplete.get(file, 'still being written')}")
+        self.complete = marker is not None and time.time() - self.last_change >= quiet and len(self.pending) == 0
+        if marker is not None and len(self.pending) > 0:
+            print(f"Error: {len(self.pending)} file{'s are' if len(self.pending) > 1 else ' is'} incomplete")
+
+        print(f"Found {len(self.done)} files")
+        return PatientHelper._sort_patients(self.patients)
+
+    def poll(self):
+        """
+        List the folder once, classify the files that have settled and validate the patients they changed
+        :return: set of the patient refs that changed
+        """
+
+        changed = set()
+        seen = set()
+        for file in PatientHelper._scan(self.path, self.recurse, self.excludes, self.suffixes):
+            if file in self.done:
+                continue
+            seen.add(file)
+            try:
+                key = FileResultCache.key(file)
+                settled = False
+                if self.pending.get(file) == key:
+                    is_complete, reason = VerifyHelper.check_tail(file)
+                    settled = is_complete is not False
+                    if not settled:
+                        # Unchanged but incomplete; only the quiet period decides how long to wait for it
+                        self.incomplete[file] = reason
+            except OSError:
+                continue
+            if not settled:
+                if self.pending.get(file) != key:
+                    self.pending[file] = key
+                    self.incomplete.pop(file, None)
+                    self.last_change = time.time()
+                continue
+
+            del self.pending[file]
+            self.incomplete.pop(file, None)
+            self.done.add(file)
+            self.last_change = time.time()
+            match = self.regex_helper.match(file)
+            if match:
+                PatientHelper.update_patient(self.patients, *match, file)
+                changed.add(match[0])
+                if debug:
+                    print(f"Added {file}")
+            else:
+                print(f"Skipping {file}")
+
+        # Files removed before they settled
+        for file in set(self.pending) - seen:
+            del self.pending[file]
+            self.incomplete.pop(file, None)
+            self.last_change = time.time()
+
+        # Samples arrive one by one so a patient can be invalid for a while, only the final state is reported
+        for p_ref in changed:
+            with contextlib.redirect_stdout(io.StringIO()):
+                valid = PatientHelper.is_valid({p_ref: self.patients[p_ref]})
+            if valid:
+                self.invalid.discard(p_ref)
+            else:
+                self.invalid.add(p_ref)
+
+        return changed
+
+    def find_marker(self):
+        """
+        :return: path of a completion marker in the watched folder or one of its parents, or None
+        """
+        folder = os.path.abspath(self.path)
+        for _ in range(RunWatcher.MARKER_DEPTH):
+            for marker in self.markers:
+                if os.path.exists(os.path.join(folder, marker)):
+                    return os.path.join(folder, marker)
+            folder = os.path.dirname(folder)
+        return None
+
+    def is_valid(self):
+        """
+        Report the problems of the patients that are still invalid, like PatientHelper.is_valid
+        :return:
+        """
+        return PatientHelper.is_valid({p_ref: self.patients[p_ref] for p_ref in sorted(self.invalid)})
+
+
+class ChecksumHelper:
+    """
+    MD5 and SHA-256 of every FastQ file, computed by threads in one pass over each file. hashlib releases the GIL
+    while hashing large buffers, so the threads overlap reading and hashing
+    """
+
+    ALGORITHMS = ("md5", "sha256")
+
+    # Bytes read at a time, and the most bytes read but not yet hashed over all threads
+    READ_SIZE = 8 * 1024 * 1024
+    BUFFER_BUDGET = 256 * 1024 * 1024
+
+    @staticmethod
+    def default_cache():
+        return os.path.join(cache_dir(), "checksums.json")
+
+    @staticmethod
+    def start(files, workers=4, budget=None, cache_file=None):
+        """
+        Start computing the checksums of files in the background, reusing results of unchanged files. The threads are
+        daemons so an early exit doesn't wait for them
+        :param files:
+        :param workers: number of threads reading and hashing files
+        :param budget: bytes in flight (defaults to BUFFER_BUDGET)
+        :param cache_file: defaults to default_cache()
+        :return: Future of (dict of {file: {"size": .., "md5": .., "sha256": ..} or {"error": ..}},
+                 number of files hashed, bytes hashed, seconds)
+        """
+
+        if budget is None:
+            budget = ChecksumHelper.BUFFER_BUDGET
+        cache = FileResultCache(cache_file if cache_file else ChecksumHelper.default_cache())
+        future = concurrent.futures.Future()
+
+        sums = dict()
+        todo = []
+        for file in files:
+            cached = cache.get(file)
+            if cached is not None:
+                sums[file] = cached
+            else:
+                todo.append(file)
+
+        pending = iter(todo)
+        lock = threading.Lock()
+        buffers = threading.BoundedSemaphore(max(1, budget // ChecksumHelper.READ_SIZE))
+        running = max(1, min(workers, len(todo)))
+        hashed = 0
+        start = time.perf_counter()
+
+        def _work():
+            nonlocal running, hashed
+            try:
+                while True:
+                    with lock:
+                        file = next(pending, None)
+                    if file is None:
+                        break
+                    key, result = ChecksumHelper._hash_file(file, buffers)
+                    with lock:
+                        sums[file] = result
+                        if key is not None:
+                            cache.put(file, key, result)
+                            hashed += key[0]
+            finally:
+                with lock:
+                    running -= 1
+                    last = running == 0
+                if last:
+                    cache.save()
+                    future.set_result((sums, len(todo), hashed, time.perf_counter() - start))
+
+        for _ in range(running):
+            threading.Thread(target=_work, daemon=True).start()
+
+        return future
+
+    @staticmethod
+    def _hash_file(path, buffers):
+        """
+        :param path:
+        :param buffers: semaphore taken while a buffer is read and hashed
+        :return: ((size, mtime_ns) before reading, or None if the result shouldn't be cached, result)
+        """
+        hashes = [hashlib.new(_algorithm) for _algorithm in ChecksumHelper.ALGORITHMS]
+        try:
+            key = FileResultCache.key(path)
+            with open(path, "rb", buffering=0) as file_in:
+                while True:
+                    with buffers:
+                        data = file_in.read(ChecksumHelper.READ_SIZE)
+                        if not data:
+                            break
+                        for _hash in hashes:
+                            _hash.update(data)
+            if FileResultCache.key(path) != key:
+                return None, {"error": "file changed while it was read"}
+        except OSError as err:
+            return None, {"error": str(err)}
+
+        result = {"size": key[0]}
+        result.update(zip(ChecksumHelper.ALGORITHMS, (_hash.hexdigest() for _hash in hashes)))
+        return key, result
+
+    @staticmethod
+    def write_manifest(filename, files, checksums):
+        """
+        Write a tab separated manifest of name, size and checksums, in the order of files
+        :param filename:
+        :param files:
+        :param checksums: result of start
+        :return: whether every file has checksums
+        """
+        lines = ["\t".join(("name", "size") + ChecksumHelper.ALGORITHMS)]
+        complete = True
+        for file in files:
+            result = checksums[file]
+            if "error" in result:
+                print(f"Error: couldn't checksum {file}: {result['error']}")
+                complete = False
+            else:
+                lines.append("\t".join([file, str(result["size"])] +
+                                       [result[_algorithm] for _algorithm in ChecksumHelper.ALGORITHMS]))
+        atomic_write(filename, "\n".join(lines) + "\n")
+        print(f"Checksums written to {filename}")
+        return complete
+
+
 class AuthHelper:
+    # Coordinates of a grid card token in the uploader's prompt, e.g. "Please enter token for coordinates [1, A]: "
+    COORDINATES_RE = re.compile(r"\[[1-8], [A-H]\]")
+
+    # Seconds to wait for the token prompt
+    PROMPT_TIMEOUT = 120
+
+    timeout = PROMPT_TIMEOUT
+    # Keep the username, password and tokens in memory for the rest of the run, so the create and list calls of every
+    # batch don't ask for them again
+    remember = False
+    credentials = None
+    tokens = dict()
 
     @staticmethod
     def access_alt_client(command, client_id):
@@ -240,7 +1289,7 @@ class AuthHelper:
         Authorise secondary client for patient command
         :param command:
         :param client_id:
-        :return:
+        :return: output of the command after the token prompt, or "" if there was no prompt
         """
         stdout = ""
 
@@ -249,51 +1298,82 @@ class AuthHelper:
         command += ["--client-id", client_id, "-u", user, "-p", password]
 
         # Start uploader
+        timing = Timings.start("uploader")
         with subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as auth_process:
-            # Try to read in token prompt
-            prompt = AuthHelper.get_prompt(auth_process)
-            if AuthHelper.contains_coordinates(prompt):
-                token = input(prompt)
+            # Everything is read in a thread, so the uploader can't block on a full pipe whatever it writes
+            reader = StreamReader(auth_process.stdout)
+            prompt = reader.wait_for(AuthHelper.find_prompt, AuthHelper.timeout)
+            if prompt is None:
+                if reader.closed:
+                    print("Error: the uploader ended without asking for a token")
+                else:
+                    print(f"Error: no token prompt from the uploader after {AuthHelper.timeout}s")
+                    auth_process.kill()
+                    reader.text()
+            else:
+                prompt, end = prompt
+                token = AuthHelper._get_token(prompt)
                 print("Sending token to subprocess")
-                stdout, stderr = auth_process.communicate(token.encode())
-                stdout = stdout.decode()
-                if stderr:
-                    print(f"stderr: {stderr}")
+                try:
+                    auth_process.stdin.write(token.encode())
+                    auth_process.stdin.close()
+                except BrokenPipeError:
+                    pass
+                auth_process.wait()
+                stdout = reader.text()[end:]
 
+        # Includes the time waiting for the token to be typed in
+        Timings.stop(timing, command=Timings.subcommand(command), returncode=auth_process.returncode, auth=True)
         return stdout
 
     @staticmethod
-    def get_prompt(auth_process):
+    def find_prompt(text):
         """
-        Read the prompt one byte at a time until it finds the colon character.
-        Assumes the terminal colon is the only one. Current prompt is "Please enter token for coordinates [1, A]: "
-        :param auth_process:
-        :return:
+        Find the token prompt: the line with the coordinates, up to the colon that follows them
+        :param text: output of the uploader so far
+        :return: (prompt, index after its colon) or None
         """
+        match = AuthHelper.COORDINATES_RE.search(text)
+        if match is None:
+            return None
+        colon = text.find(":", match.end())
+        if colon < 0:
+            return None
+        start = text.rfind("\n", 0, match.start()) + 1
+        return f"{text[start:colon].strip()}: ", colon + 1
 
-        prompt = ""
-        bytes_to_read = 1
-
-        next_char = auth_process.stdout.read(bytes_to_read).decode()
-        if len(next_char) == bytes_to_read:
-            while next_char != ":":
-                prompt += next_char
-                next_char = auth_process.stdout.read(bytes_to_read).decode()
-        else:
-            print("Error when reading prompt from subprocess")
+    @staticmethod
+    def _get_token(prompt):
+        """
+        Ask user for the token, unless remember is set and the same coordinates were asked before
+        :param prompt:
+        :return:
+        """
+        coordinates = AuthHelper.COORDINATES_RE.search(prompt).group(0)
+        if AuthHelper.remember and coordinates in AuthHelper.tokens:
+            print(f"Using the token given before for {coordinates}")
+            return AuthHelper.tokens[coordinates]
 
-        return f"{prompt}: "
+        token = input(prompt)
+        if AuthHelper.remember:
+            AuthHelper.tokens[coordinates] = token
+        return token
 
     @staticmethod
     def _get_auth_info():
         """
-        Ask user for username and password
+        Ask user for username and password, unless remember is set and they were given before
         :return:
         """
 
+        if AuthHelper.remember and AuthHelper.credentials is not None:
+            return AuthHelper.credentials
+
         user = input("Please enter your username: ")
         password = getpass.getpass("Please enter your password: ")
 
+        if AuthHelper.remember:
+            AuthHelper.credentials = (user, password)
         return user, password
 
     @staticmethod
@@ -303,63 +1383,157 @@ class AuthHelper:
         :param prompt:
         :return:
         """
-        pattern = r"\[[1-8], [A-H]\]"
-        match = re.search(pattern, prompt)
-        return match
+        return AuthHelper.COORDINATES_RE.search(prompt)
+
+
+class StreamReader:
+    """
+    Reads a pipe in a thread, a chunk at a time as data arrives, so the process writing it never blocks on a full
+    pipe. The caller can wait for something to turn up in what has been read so far
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.data = bytearray()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        while True:
+            try:
+                chunk = os.read(self.stream.fileno(), StreamReader.CHUNK_SIZE)
+            except (OSError, ValueError):
+                chunk = b""
+            with self.condition:
+                if chunk:
+                    self.data += chunk
+                else:
+                    self.closed = True
+                self.condition.notify_all()
+            if not chunk:
+                return
+
+    def wait_for(self, find, timeout):
+        """
+        :param find: function of the text read so far, returning None until it finds what it looks for
+        :param timeout: seconds
+        :return: the result of find, or None if the stream was closed or the timeout passed first
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                result = find(self.data.decode(errors="replace"))
+                if result is not None or self.closed:
+                    return result
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def text(self):
+        """
+        Wait for the end of the stream
+        :return: everything read
+        """
+        self.thread.join()
+        return self.data.decode(errors="replace")
 
 
 class UserHelper:
+    USER_INFO_ARGS = ["userInfo"]
+    PIPELINE_LIST_ARGS = ["pipeline", "--list"]
+
+    # UploaderCache shared by the lookups (optional)
+    cache = None
+
     @staticmethod
-    def get_user_info(command):
+    def cached(name):
         """
+        :param name: "userInfo" or "pipelines"
+        :return: the cached result, or None if there is no cache or it has expired
+        """
+        return UserHelper.cache.get(name) if UserHelper.cache is not None else None
+
+    @staticmethod
+    def get_user_info(command, result=None):
+        """
+        :param command:
+        :param result: output of an already finished `userInfo` run (optional)
         :return: userId and clientID from userInfo command
         """
 
         user_id = -1
         client_id = -1
 
-        # Execute `userInfo`
-        print("Fetching userInfo")
-        command += ["userInfo"]
-        result = run(command)
-        Logger.log(result)
+        result_json = UserHelper.cached("userInfo")
+        if result_json is not None:
+            print("Using cached userInfo")
+        else:
+            # Execute `userInfo`
+            print("Fetching userInfo")
+            if result is None:
+                result = run(command + UserHelper.USER_INFO_ARGS)
+            Logger.log(result)
 
-        try:
-            result_json = json.loads(result.stdout)
-            if "userId" in result_json:
-                user_id = result_json["userId"]
-            if "clientId" in result_json:
-                client_id = result_json["clientId"]
-        except json.decoder.JSONDecodeError:
-            print("Error: couldn't retrieve userInfo")
+            try:
+                result_json = json.loads(result.stdout)
+            except json.decoder.JSONDecodeError:
+                print("Error: couldn't retrieve userInfo")
+                return user_id, client_id
+
+        if "userId" in result_json:
+            user_id = result_json["userId"]
+        if "clientId" in result_json:
+            client_id = result_json["clientId"]
+
+        if UserHelper.cache is not None and user_id != -1 and client_id != -1:
+            UserHelper.cache.put("userInfo", {"userId": user_id, "clientId": client_id})
 
         return user_id, client_id
 
     @staticmethod
-    def get_pipeline(command, pipeline_id):
+    def get_pipeline(command, pipeline_id, result=None):
         """
         If no pipeline_id provided, list those found and user chooses. If valid choice return associated sequencerId
+        :param command:
+        :param pipeline_id:
+        :param result: output of an already finished `pipeline --list` run (optional)
         :return: pipelineId and sequencerId for provided pipeline_id (default to -1, -1)
         """
         sequencer_id = -1
+        available_pipelines = None
+
+        cached = UserHelper.cached("pipelines")
+        if cached is not None:
+            print("Using cached pipelines")
+            available_pipelines = UserHelper._pipeline_map(cached)
+            # A pipeline missing from the cache may have been added since, so only trust the cache if it knows it
+            if pipeline_id != -1 and UserHelper._to_id(pipeline_id) not in available_pipelines:
+                available_pipelines = None
+
+        if available_pipelines is None:
+            # Execute the `pipeline --list` command and get the output as Json
+            print("Fetching available pipelines")
+            if result is None:
+                result = run(command + UserHelper.PIPELINE_LIST_ARGS)
+            try:
+                result_json = json.loads(result.stdout)
+            except json.decoder.JSONDecodeError:
+                Logger.log(result)
+                print("Error: couldn't retrieve pipelines")
+                return pipeline_id, sequencer_id
 
-        # Execute the `pipeline --list` command and get the output as Json
-        print("Fetching available pipelines")
-        command += ["pipeline", "--list"]
-        result = run(command)
-        result_json = json.loads(result.stdout)
-
-        # A single pipeline found; put it in a list
-        if isinstance(result_json, dict):
-            result_json = [result_json]
+            # A single pipeline found; put it in a list
+            if isinstance(result_json, dict):
+                result_json = [result_json]
 
-        # Create map of pipeline_id -> (pipeline_name, sequencer_id)
-        available_pipelines = dict()
-        for pipeline in result_json:
-            pid = pipeline["pipeline_id"]
-            name = pipeline["pipeline_name"]
-            seq = pipeline["sequencer_id"]
-            available_pipelines[pid] = (name, seq)
+            available_pipelines = UserHelper._pipeline_map(result_json)
+            if UserHelper.cache is not None:
+                UserHelper.cache.put("pipelines", result_json)
 
         # Pipeline not specified on command line; ask user now
         if pipeline_id == -1:
@@ -369,8 +1543,7 @@ class UserHelper:
             pipeline_id = input("Enter pipeline ID: ")
 
         # Convert the pipeline_id to int
-        if pipeline_id.isnumeric():
-            pipeline_id = int(pipeline_id)
+        pipeline_id = UserHelper._to_id(pipeline_id)
 
         # Check available pipelines for specifed id
         for pid, (_, seq) in available_pipelines.items():
@@ -383,6 +1556,96 @@ class UserHelper:
 
         return pipeline_id, sequencer_id
 
+    @staticmethod
+    def _pipeline_map(pipelines):
+        """
+        :param pipelines: list of pipelines from `pipeline --list`
+        :return: map of pipeline_id -> (pipeline_name, sequencer_id)
+        """
+        available_pipelines = dict()
+        for pipeline in pipelines:
+            pid = pipeline["pipeline_id"]
+            name = pipeline["pipeline_name"]
+            seq = pipeline["sequencer_id"]
+            available_pipelines[pid] = (name, seq)
+        return available_pipelines
+
+    @staticmethod
+    def _to_id(pipeline_id):
+        if isinstance(pipeline_id, str) and pipeline_id.isnumeric():
+            return int(pipeline_id)
+        return pipeline_id
+
+
+class UploaderCache:
+    """
+    userInfo and pipeline list results of earlier runs, kept per uploader jar and config override file for ttl
+    seconds. Every write re-reads the file and replaces it atomically, so concurrent runs can't corrupt it.
+    The account logged in to the uploader isn't part of the key, as it can't be seen from here, so the cache is only
+    used with --cache-ttl
+    """
+
+    def __init__(self, filename, key, ttl, refresh=False):
+        """
+        :param filename:
+        :param key: see UploaderCache.key()
+        :param ttl: seconds a result stays valid
+        :param refresh: ignore cached results (new results are still stored)
+        """
+        self.filename = filename
+        self.key = key
+        self.ttl = ttl
+        self.refresh = refresh
+
+    @staticmethod
+    def default_path():
+        return os.path.join(cache_dir(), "uploader.json")
+
+    @staticmethod
+    def key(jar, yaml):
+        """
+        :param jar: uploader jar
+        :param yaml: micronaut config override file, which selects the login (optional)
+        :return:
+        """
+        parts = [os.path.abspath(jar)]
+        if yaml:
+            parts += [os.path.abspath(yaml), os.stat(yaml).st_mtime_ns]
+        return hashlib.md5(json.dumps(parts).encode()).hexdigest()
+
+    def get(self, name):
+        if self.refresh:
+            return None
+        entry = self._load().get(self.key, dict()).get(name)
+        if entry is None or time.time() - entry["time"] > self.ttl:
+            return None
+        return entry["value"]
+
+    def put(self, name, value):
+        data = self._load()
+        now = time.time()
+        data.setdefault(self.key, dict())[name] = {"time": now, "value": value}
+
+        # Drop whatever has expired, including other logins
+        for key in list(data.keys()):
+            data[key] = {n: e for n, e in data[key].items() if now - e["time"] <= self.ttl}
+            if len(data[key]) == 0:
+                del data[key]
+
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            atomic_write(self.filename, json.dumps(data))
+        except OSError as err:
+            print(f"Warning: couldn't write {self.filename}: {err}")
+
+    def _load(self):
+        try:
+            with open(self.filename, "r") as file_in:
+                data = json.load(file_in)
+            return data if isinstance(data, dict) else dict()
+        except (OSError, ValueError):
+            return dict()
+
 
 class JsonBuilder:
     # Map tags to analyses->definition->libraryType
@@ -408,7 +1671,8 @@ class JsonBuilder:
     }
 
     @staticmethod
-    def build_json(user_ref, user_id, client_id, pipeline_id, sequencer_id, patient_data, patient_ids, sample_type_id):
+    def build_json(user_ref, user_id, client_id, pipeline_id, sequencer_id, patient_data, patient_ids, sample_type_id,
+                   compact=False):
         """
         :param user_ref:
         :param user_id:
@@ -418,9 +1682,58 @@ class JsonBuilder:
         :param patient_data:
         :param patient_ids:
         :param sample_type_id:
+        :param compact: no indentation or spaces
         :return: ADE format json object
         """
-        ade_dict = {
+        analyses = JsonBuilder._build_analyses(patient_data, patient_ids, pipeline_id, sample_type_id)
+        topologies = JsonBuilder._build_topologies(patient_data)
+        ade_dict = JsonBuilder._build_ade(user_ref, user_id, client_id, sequencer_id, analyses, topologies)
+
+        return JsonBuilder._encoder(compact).encode(ade_dict)
+
+    @staticmethod
+    def write_json(file_out, user_ref, user_id, client_id, pipeline_id, sequencer_id, patient_data, patient_ids,
+                   sample_type_id, compact=False):
+        """
+        Write the same document as build_json to file_out, building and writing the analyses and topologies one at a
+        time instead of holding the whole document in memory
+        :param file_out: text file
+        :param user_ref:
+        :param user_id:
+        :param client_id:
+        :param pipeline_id:
+        :param sequencer_id:
+        :param patient_data:
+        :param patient_ids:
+        :param sample_type_id:
+        :param compact: no indentation or spaces
+        :return:
+        """
+        analyses = StreamedList(JsonBuilder._iter_analyses(patient_data, patient_ids, pipeline_id, sample_type_id))
+        topologies = StreamedList(JsonBuilder._iter_topologies(patient_data))
+        ade_dict = JsonBuilder._build_ade(user_ref, user_id, client_id, sequencer_id, analyses, topologies)
+
+        for chunk in JsonBuilder._encoder(compact).iterencode(ade_dict):
+            file_out.write(chunk)
+
+    @staticmethod
+    def _encoder(compact):
+        if compact:
+            return json.JSONEncoder(separators=(",", ":"))
+        return json.JSONEncoder(indent=3)
+
+    @staticmethod
+    def _build_ade(user_ref, user_id, client_id, sequencer_id, analyses, topologies):
+        """
+        :param user_ref:
+        :param user_id:
+        :param client_id:
+        :param sequencer_id:
+        :param analyses: list of analyses, or a StreamedList of them
+        :param topologies: list of topologies, or a StreamedList of them
+        :return: ADE dict
+        """
+        return {
             "protocolName": "ADE",
             "protocolVersion": "1",
             "client": {
@@ -436,14 +1749,12 @@ class JsonBuilder:
                     "isPrevent": False
                 },
                 "state": None,
-                "analyses": JsonBuilder._build_analyses(patient_data, patient_ids, pipeline_id, sample_type_id),
-                "topology": JsonBuilder._build_topologies(patient_data),
+                "analyses": analyses,
+                "topology": topologies,
                 "files": []
             }
         }
 
-        return json.dumps(ade_dict, indent=3)
-
     @staticmethod
     def _build_analyses(patient_data, patient_ids, pipeline_id, sample_type_id):
         """
@@ -451,70 +1762,99 @@ class JsonBuilder:
         :param pipeline_id:
         :return: list of analyses for ADE
         """
-        analyses = []
-        for patient_ref, samples in patient_data.items():
-            for sample_id, data in samples.items():
-                tag = data[0]
-                personal_information_id, medical_information_id = patient_ids[patient_ref]
-                analyses.append(
-                    {
-                        "definition": {
-                            "sampleId": sample_id,
-                            "multiplexId": sample_id,
-                            "sgaPipelineId": pipeline_id,
-                            "userRef": patient_ref if len(tag) == 0 else f"{patient_ref}-{tag}",
-                            "sampleTypeId": sample_type_id,
-                            "libraryType": JsonBuilder.lib_type[tag],
-                        },
-                        "patient": {
-                            "personalInformationId": personal_information_id,
-                            "medicalInformationId": medical_information_id
-                        },
-                        "isControlSample": False,
-                        "files": [
-                            {
-                                "definition": {
-                                    "name": file
-                                },
-                            } for file in data[1:]
-                        ]
-                    }
-                )
-
-        return analyses
+        return list(JsonBuilder._iter_analyses(patient_data, patient_ids, pipeline_id, sample_type_id))
 
     @staticmethod
-    def _build_topologies(patient_data):
+    def _iter_analyses(patient_data, patient_ids, pipeline_id, sample_type_id):
         """
         :param patient_data:
-        :return: list of topologies for ADE
+        :param pipeline_id:
+        :return: generator of the analyses for ADE
         """
-        topologies = []
-        for patient_ref, samples in patient_data.items():
-            tags = [val[0] for val in samples.values()]
-            tags.sort()
-            # Only create a topology if there's a pair of D/R or N/T samples
-            if len(tags) != 2 or (tags != ["D", "R"] and (tags != ["N", "T"])):
-                continue
-            topologies.append(
-                {
+        for patient_ref, patient in patient_data.items():
+            personal_information_id, medical_information_id = patient_ids[patient_ref]
+            for sample in patient:
+                tag = sample.tag
+                yield {
                     "definition": {
-                        "type": JsonBuilder.top_type[tags[0]]
+                        "sampleId": sample.sample_id,
+                        "multiplexId": sample.sample_id,
+                        "sgaPipelineId": pipeline_id,
+                        "userRef": patient_ref if len(tag) == 0 else f"{patient_ref}-{tag}",
+                        "sampleTypeId": sample_type_id,
+                        "libraryType": JsonBuilder.lib_type[tag],
                     },
-                    "references": [
+                    "patient": {
+                        "personalInformationId": personal_information_id,
+                        "medicalInformationId": medical_information_id
+                    },
+                    "isControlSample": False,
+                    "files": [
                         {
-                            "analysisReference": {
-                                "sampleId": sample_id
+                            "definition": {
+                                "name": file
                             },
-                            "role": JsonBuilder.role[data[0]],
-                            "metadata": {}
-                        }
-                        for sample_id, data in samples.items()
+                        } for file in sample
                     ]
                 }
-            )
 
-        return topologies
+    @staticmethod
+    def _build_topologies(patient_data):
+        """
+        :param patient_data:
+        :return: list of topologies for ADE
+        """
+        return list(JsonBuilder._iter_topologies(patient_data))
+
+    @staticmethod
+    def _iter_topologies(patient_data):
+        """
+        :param patient_data:
+        :return: generator of the topologies for ADE
+        """
+        for patient in patient_data.values():
+            # Only create a topology if there's a pair of D/R or N/T samples
+            if patient.topology is None:
+                continue
+            yield {
+                "definition": {
+                    "type": patient.topology
+                },
+                "references": [
+                    {
+                        "analysisReference": {
+                            "sampleId": sample.sample_id
+                        },
+                        "role": JsonBuilder.role[sample.tag],
+                        "metadata": {}
+                    }
+                    for sample in patient
+                ]
+            }
+
+
+class StreamedList(list):
+    """
+    Stands in for a list in a document given to json.JSONEncoder.iterencode, which walks lists with a plain for loop:
+    the items are taken from an iterator as they are encoded, so only one is in memory at a time. It can only be
+    encoded once
+    """
+
+    _EMPTY = object()
+
+    def __init__(self, items):
+        super().__init__()
+        self._items = iter(items)
+        # Take the first item now, so an empty list still encodes as []
+        self._first = next(self._items, StreamedList._EMPTY)
+
+    def __bool__(self):
+        return self._first is not StreamedList._EMPTY
+
+    def __iter__(self):
+        if self._first is not StreamedList._EMPTY:
+            yield self._first
+            yield from self._items
 
 
 class Logger:
@@ -535,6 +1875,137 @@ class Logger:
             print(err)
 
 
+class Timings:
+    """
+    Wall and CPU time of the stages of a run, for --timings. start returns None and iterate returns its argument
+    unchanged while disabled, so the calls cost next to nothing then. Stages can nest: classify includes the time of
+    the scan it pulls files from, and each uploader call is also part of the stage that made it
+    """
+
+    enabled = False
+    stages = []
+    started = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def enable():
+        Timings.enabled = True
+        Timings.started = time.perf_counter()
+
+    @staticmethod
+    def start(name):
+        """
+        :param name:
+        :return: token for stop, or None when disabled
+        """
+        if not Timings.enabled:
+            return None
+        return name, time.perf_counter(), time.thread_time()
+
+    @staticmethod
+    def stop(token, **info):
+        """
+        Record the stage started with token
+        :param token: return value of start
+        :param info: e.g. file counts, added to the record
+        :return:
+        """
+        if token is not None:
+            name, wall, cpu = token
+            Timings.record(name, time.perf_counter() - wall, time.thread_time() - cpu, **info)
+
+    @staticmethod
+    def record(name, wall, cpu=None, **info):
+        """
+        Record a stage timed elsewhere, e.g. by a background thread
+        :param name:
+        :param wall: seconds
+        :param cpu: seconds of CPU of the thread that ran it (optional)
+        :param info:
+        :return:
+        """
+        if not Timings.enabled:
+            return
+        stage = {"stage": name, "wall": round(wall, 6)}
+        if cpu is not None:
+            stage["cpu"] = round(cpu, 6)
+        stage.update(info)
+        with Timings._lock:
+            Timings.stages.append(stage)
+
+    @staticmethod
+    def iterate(name, iterable):
+        """
+        Time spent producing the items of iterable, e.g. walking folders, recorded once it's exhausted
+        :param name:
+        :param iterable:
+        :return: iterable itself when disabled
+        """
+        if not Timings.enabled:
+            return iterable
+        return Timings._iterate(name, iter(iterable))
+
+    @staticmethod
+    def _iterate(name, iterator):
+        wall = cpu = 0.0
+        count = 0
+        while True:
+            start, start_cpu = time.perf_counter(), time.thread_time()
+            item = next(iterator, Timings)
+            wall += time.perf_counter() - start
+            cpu += time.thread_time() - start_cpu
+            if item is Timings:
+                break
+            count += 1
+            yield item
+        Timings.record(name, wall, cpu, items=count)
+
+    @staticmethod
+    def subcommand(command):
+        """
+        :param command: uploader command
+        :return: the uploader subcommand and its first flag, e.g. "patient -c", without any credentials
+        """
+        jar = next((_i for _i, _arg in enumerate(command) if _arg.endswith((".jar", ".py"))), -1)
+        args = [_arg for _arg in command[jar + 1:] if not _arg.startswith("-D")][:2]
+        if len(args) == 2 and (not args[1].startswith("-") or "=" in args[1] or args[1] in ("-u", "-p")):
+            args = args[:1]
+        return " ".join(args)
+
+    @staticmethod
+    def write(filename, **info):
+        """
+        Append one json line with the stages, total wall and CPU time and peak RSS of this process and its children
+        (the uploader JVMs and worker processes) to filename, or write it to stderr if filename is "-"
+        :param filename:
+        :param info: e.g. the exit code, added to the record
+        :return:
+        """
+        record = {"time": datetime.datetime.now().astimezone().isoformat(timespec="seconds"), "pid": os.getpid()}
+        record.update(info)
+        record["wall"] = round(time.perf_counter() - Timings.started, 6)
+        if resource is not None:
+            # ru_maxrss is in KiB on Linux and bytes on macOS
+            scale = 1 if sys.platform == "darwin" else 1024
+            for key, who in (("", resource.RUSAGE_SELF), ("children_", resource.RUSAGE_CHILDREN)):
+                usage = resource.getrusage(who)
+                record[f"{key}cpu"] = round(usage.ru_utime + usage.ru_stime, 6)
+                record[f"{key}peak_rss"] = usage.ru_maxrss * scale
+        else:
+            record["cpu"] = round(time.process_time(), 6)
+        record["stages"] = Timings.stages
+
+        line = json.dumps(record) + "\n"
+        if filename == "-":
+            sys.stderr.write(line)
+            return
+        try:
+            with open(filename, "a") as f_out:
+                f_out.write(line)
+        except OSError as err:
+            print(f"Warning: couldn't write timings to {filename}: {err}")
+
+
 def confirm():
     """
     Dispplay warnings/info and return whether user wishes to continue
@@ -549,11 +2020,42 @@ def confirm():
     return input("Do you wish to continue? (y/n) ").strip()[0].lower() == "y"
 
 
+def cache_dir():
+    """
+    :return: per-user folder for adegen.py caches
+    """
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "adegen")
+
+
+def atomic_write(filename, text):
+    """
+    Write text to a temporary file in the same folder and move it over filename, so readers never see a partial file
+    :param filename:
+    :param text:
+    :return:
+    """
+    folder = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile("w", dir=folder, prefix=".tmp-", delete=False) as f_out:
+        f_out.write(text)
+    try:
+        os.replace(f_out.name, filename)
+    except OSError:
+        os.remove(f_out.name)
+        raise
+
+
 def run(command):
     global debug
     if debug:
         print("[DEBUG] Command to be run:", command)
-    return subprocess.run(command, capture_output=True, text=True)
+    timing = Timings.start("uploader")
+    result = subprocess.run(command, capture_output=True, text=True)
+    Timings.stop(timing, command=Timings.subcommand(command), returncode=result.returncode)
+    return result
 
 
 class RegexHelper:
@@ -561,22 +2063,48 @@ class RegexHelper:
     ILLUMINA_RE = r"^([^_]+?)(-([DRTN]))?_(S[1-9][0-9]*)_L\d+_R\d+_\d+\.fastq\.gz$"
     ILLUMINA_BREAKDOWN = ["0", "3", "2"]
 
-    def __init__(self, filename):
+    def __init__(self, filename, combined=True):
         if filename is None:
             # Default to Illumina
             self.exprs = [(RegexHelper.ILLUMINA_RE, RegexHelper.ILLUMINA_BREAKDOWN)]
         else:
             self.exprs = RegexHelper.load_expressions(filename)
 
-        self.functions = RegexHelper.build_functions(self.exprs)
+        self.combined = RegexHelper.build_combined(self.exprs) if combined else None
+        if self.combined is None:
+            self.separate = RegexHelper.build_separate(self.exprs)
 
     def update(self, filename, patients):
-        updated = False
-        for _func in self.functions:
-            updated = _func(filename, patients)
-            if updated:
-                break
-        return updated
+        match = self.match(filename)
+        if match:
+            PatientHelper.update_patient(patients, *match, filename)
+        return match is not None
+
+    def match(self, filename):
+        """
+        :param filename:
+        :return: (p_ref, sample_id, tag) from the first matching expression, or None
+        """
+        basename = os.path.basename(filename)
+
+        if self.combined is not None:
+            regex, templates = self.combined
+            match = regex.match(basename)
+            if match:
+                return RegexHelper._apply(match, templates[match.lastgroup])
+            return None
+
+        for regex, templates in self.separate:
+            match = regex.search(basename)
+            if match:
+                return RegexHelper._apply(match, templates)
+        return None
+
+    def signature(self):
+        """
+        :return: digest identifying the expressions, used to invalidate cached results
+        """
+        return hashlib.md5(json.dumps(self.exprs).encode()).hexdigest()
 
     @staticmethod
     def load_expressions(file):
@@ -592,60 +2120,463 @@ class RegexHelper:
         return exprs
 
     @staticmethod
-    def build_functions(exprs):
-        funcs = []
+    def build_combined(exprs):
+        """
+        Merge all expressions into one alternation with a named group per expression. Unanchored alternatives are
+        preceded by a lazy .*? so that, as with one re.search per expression, the first expression that matches
+        anywhere wins
+        :param exprs:
+        :return: (compiled regex, {group name: templates}) or None if the expressions can't be combined
+        """
 
-        for _expr in exprs:
-            _regex = re.compile(_expr[0])
-            _p_ref_ex = _expr[1][0]
-            _mid_ex = _expr[1][1]
-            _tag_ex = _expr[1][2] if len(_expr[1]) == 3 else None
-            funcs.append(RegexHelper._build_function(_regex, _p_ref_ex, _mid_ex, _tag_ex))
+        alternatives = []
+        for _i, (_regex, _) in enumerate(exprs):
+            # Numbered backreferences and conditionals would point at the wrong group once combined
+            if re.search(r"\\[1-9]|\(\?\(", _regex):
+                return None
+            prefix = "" if RegexHelper._is_anchored(_regex) else "(?s:.*?)"
+            alternatives.append(f"{prefix}(?P<_e{_i}>{_regex})")
 
-        return funcs
+        try:
+            regex = re.compile("|".join(alternatives))
+        except re.error:
+            # e.g. inline global flags or group names used by more than one expression
+            return None
 
-    @staticmethod
-    def _build_function(regex, p_ref_ex, mid_ex, tag_ex):
-        def _func(filename, patients):
-            basename = os.path.basename(filename)
-            match = re.search(regex, basename)
-            if match:
-                p_ref = "".join([match.groups()[int(_c)] if _c.isdigit() else _c for _c in p_ref_ex])
-                mid = "".join([match.groups()[int(_c)] if _c.isdigit() else _c for _c in mid_ex])
-                tag = ""
-                try:
-                    tag = "".join([match.groups()[int(_c)] if _c.isdigit() else _c for _c in tag_ex])
-                except TypeError:
-                    # List comprehension evaluates to [None] for Illumina without a tag, so ignore this
-                    pass
+        templates = dict()
+        for _i, (_, breakdown) in enumerate(exprs):
+            name = f"_e{_i}"
+            templates[name] = RegexHelper._compile_breakdown(breakdown, regex.groupindex[name])
 
-                PatientHelper.update_patient(patients, p_ref, mid, tag, filename)
-                return True
-            else:
+        return regex, templates
+
+    @staticmethod
+    def _is_anchored(regex):
+        """
+        Whether regex can only match at the start of the string: it starts with ^ or \\A and has no top level |
+        :param regex:
+        :return:
+        """
+        if not regex.startswith(("^", "\\A")):
+            return False
+
+        depth = 0
+        in_class = False
+        escaped = False
+        for _i, _c in enumerate(regex):
+            if escaped:
+                escaped = False
+            elif _c == "\\":
+                escaped = True
+            elif in_class:
+                # A ] straight after [ or [^ is a literal
+                in_class = _c != "]" or regex[_i - 1] == "[" or regex[_i - 2:_i] == "[^"
+            elif _c == "[":
+                in_class = True
+            elif _c == "(":
+                depth += 1
+            elif _c == ")":
+                depth -= 1
+            elif _c == "|" and depth == 0:
                 return False
+        return True
+
+    @staticmethod
+    def build_separate(exprs):
+        """
+        :param exprs:
+        :return: list of (compiled regex, templates), tried one by one
+        """
+        return [(re.compile(_regex), RegexHelper._compile_breakdown(breakdown, 0)) for _regex, breakdown in exprs]
+
+    @staticmethod
+    def _compile_breakdown(breakdown, offset):
+        """
+        Turn the p_ref, mid and tag specs (e.g. "0", "3", "2") into templates of group indexes and literal strings.
+        Each digit refers to match.groups() of the expression, which is group offset + digit + 1 in the regex
+        :param breakdown:
+        :param offset: index of the group wrapping the expression (0 when compiled on its own)
+        :return: (p_ref template, mid template, tag template or None)
+        """
+
+        def _compile(spec):
+            template = []
+            for _c in spec:
+                if _c.isdigit():
+                    template.append(offset + int(_c) + 1)
+                elif len(template) > 0 and isinstance(template[-1], str):
+                    template[-1] += _c
+                else:
+                    template.append(_c)
+            return tuple(template)
+
+        tag_ex = _compile(breakdown[2]) if len(breakdown) == 3 else None
+        return _compile(breakdown[0]), _compile(breakdown[1]), tag_ex
 
-        return _func
+    @staticmethod
+    def _apply(match, templates):
+        """
+        :param match:
+        :param templates:
+        :return: (p_ref, mid, tag) or None if the p_ref or mid groups didn't take part in the match
+        """
+
+        def _fill(template):
+            if len(template) == 1 and isinstance(template[0], int):
+                return match.group(template[0])
+            parts = [match.group(_t) if isinstance(_t, int) else _t for _t in template]
+            return None if None in parts else "".join(parts)
+
+        p_ref_tpl, mid_tpl, tag_tpl = templates
+        p_ref = _fill(p_ref_tpl)
+        mid = _fill(mid_tpl)
+        if p_ref is None or mid is None:
+            return None
+
+        # An optional tag group (e.g. Illumina without -D/-R) gives an empty tag
+        tag = ""
+        if tag_tpl is not None:
+            tag = _fill(tag_tpl) or ""
+
+        return p_ref, mid, tag
+
+
+def read_folder(folder, options, workers=1):
+    """
+    Find and check the patient data of a folder as given by the command line options
+    :param folder: relative to the current directory
+    :param options: parsed command line arguments
+    :param workers: number of processes reading, classifying and verifying files
+    :return: (exit code, patient data)
+    """
+
+    folder = os.path.join(os.getcwd(), folder)
+    index_file = None
+    if options.index is not None:
+        index_file = options.index if options.index else ScanIndex.default_path(folder)
+    if options.watch:
+        watcher = RunWatcher(folder, options.deep, options.regex, options.exclude, options.marker)
+        patient_data = watcher.watch(options.quiet_period, timeout=options.watch_timeout)
+        if not watcher.complete:
+            return 10, None
+    else:
+        watcher = None
+        patient_data = PatientHelper.read(folder, options.deep, options.regex, options.exclude, index_file, workers,
+                                          options.settle)
+    if patient_data is None or len(patient_data) == 0:
+        print("No patient data found")
+        return 1, None
+
+    timing = Timings.start("validate")
+    valid = watcher.is_valid() if watcher else PatientHelper.is_valid(patient_data)
+    Timings.stop(timing, patients=len(patient_data))
+    if not valid:
+        return 2, None
+
+    if options.verify and not VerifyHelper.verify(patient_data, workers):
+        return 8, None
+
+    return 0, patient_data
+
+
+def _read_folder_quietly(folder, options):
+    """
+    read_folder in a worker process, with its output captured so the folders of a batch don't get mixed up
+    :param folder:
+    :param options:
+    :return: (exit code, patient data, output, stages recorded by Timings)
+    """
+    global debug
+    debug = options.verbose
+    if options.timings and not Timings.enabled:
+        Timings.enable()
+    first_stage = len(Timings.stages)
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        try:
+            code, patient_data = read_folder(folder, options)
+        except Exception as err:
+            print(f"Error: {err}")
+            code, patient_data = 1, None
+    return code, patient_data, output.getvalue(), Timings.stages[first_stage:]
+
+
+def generate_ade(command, folder, patient_data, options, output=None, checksums=None, results=None):
+    """
+    Create the patients of a folder and write its ADE
+    :param command: uploader command
+    :param folder: as given on the command line, the run name defaults to its name
+    :param patient_data:
+    :param options: parsed command line arguments
+    :param output: Json file, relative to the current directory (printed if None)
+    :param checksums: checksum manifest to write (optional)
+    :param results: dict of the userInfo and pipeline list results, reused and filled in for the next folders
+    :return: exit code
+    """
+
+    if results is None:
+        results = dict()
+
+    checksums_future = None
+    if checksums:
+        checksums_future = ChecksumHelper.start(PatientHelper.list_files(patient_data), options.checksum_workers)
+
+    # userInfo and the pipeline list don't depend on the patients, so fetch them while the patients are created.
+    # Their output is only printed once they are used below, so it can't get mixed up with the patient prompts
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        futures = dict()
+        if "userInfo" not in results and UserHelper.cached("userInfo") is None:
+            futures["userInfo"] = executor.submit(run, command + UserHelper.USER_INFO_ARGS)
+        if "pipelines" not in results and UserHelper.cached("pipelines") is None:
+            futures["pipelines"] = executor.submit(run, command + UserHelper.PIPELINE_LIST_ARGS)
+
+        # Get a dict of {patient_ref: (personalID, medicalId), . . . } for each patient
+        timing = Timings.start("create_patients")
+        patients_ids = PatientHelper.create_patients(command[:], patient_data, options.clientId,
+                                                     options.batch_size, options.batch_workers)
+        Timings.stop(timing, patients=len(patient_data))
+        for name, future in futures.items():
+            results[name] = future.result()
+
+    if patients_ids is None:
+        return 3
+
+    # Get user info
+    user_id, client_id = UserHelper.get_user_info(command[:], results.get("userInfo"))
+    if options.clientId:
+        client_id = int(options.clientId)
+    if user_id == -1 or client_id == -1:
+        return 4
+
+    # Get pipeline info
+    pipeline_id, sequencer_id = UserHelper.get_pipeline(command[:], options.pipeline, results.get("pipelines"))
+    if sequencer_id == -1:
+        return 5
+
+    # Get userRef
+    if options.ref:
+        user_ref = options.ref
+    else:
+        user_ref = f'{pathlib.PurePath(folder).name}_{datetime.datetime.now().strftime("%Y%m%d%H%M")}'
+
+    # Put the ADE together, writing it to file if given, otherwise printing it to console
+    # The ADE is streamed, so building it and writing it are one stage
+    ade_args = (user_ref, user_id, client_id, pipeline_id, sequencer_id, patient_data, patients_ids,
+                options.sampletype, options.compact)
+    timing = Timings.start("build_json")
+    if output:
+        save_path = os.path.join(os.getcwd(), output)
+        with open(save_path, "w") as f_out:
+            JsonBuilder.write_json(f_out, *ade_args)
+            size = f_out.tell()
+        print(f"Json written to {save_path}")
+    else:
+        JsonBuilder.write_json(sys.stdout, *ade_args)
+        print()
+        size = None
+    Timings.stop(timing, analyses=sum(map(len, patient_data.values())), bytes=size)
+
+    if checksums_future is not None:
+        if not checksums_future.done():
+            print("Waiting for checksums")
+        timing = Timings.start("checksums_wait")
+        sums, hashed_files, hashed_bytes, seconds = checksums_future.result()
+        Timings.stop(timing)
+        Timings.record("checksums", seconds, files=hashed_files, bytes=hashed_bytes)
+        if hashed_files > 0:
+            print(f"Checksummed {hashed_files} files, {hashed_bytes / 1e6:.0f} MB in {seconds:.1f}s "
+                  f"({hashed_bytes / 1e6 / max(seconds, 1e-9):.0f} MB/s)")
+        if not ChecksumHelper.write_manifest(os.path.join(os.getcwd(), checksums),
+                                             PatientHelper.list_files(patient_data), sums):
+            return 9
+
+    return 0
+
+
+# Keys of a batch manifest line, besides "folder", and the options they replace for that folder
+MANIFEST_KEYS = {"pipeline": "pipeline", "sampletype": "sampletype", "ref": "ref", "clientId": "clientId",
+                 "regex": "regex", "output": "output", "checksums": "checksums"}
+
+
+def read_manifest(filename):
+    """
+    Read a batch manifest: one json object per line with a "folder" and optionally any of MANIFEST_KEYS, e.g.
+    {"folder": "runs/220101_A01", "pipeline": 12, "ref": "Run 1"}. Blank lines and lines starting with # are skipped
+    :param filename:
+    :return: list of dicts
+    """
+    entries = []
+    number = 0
+    try:
+        with open(filename, "r") as file_in:
+            for number, line in enumerate(file_in, 1):
+                if not line.strip() or line.lstrip().startswith("#"):
+                    continue
+                entry = json.loads(line)
+                if not isinstance(entry, dict) or "folder" not in entry:
+                    raise ValueError("expected an object with a folder")
+                unknown = set(entry) - set(MANIFEST_KEYS) - {"folder"}
+                if unknown:
+                    raise ValueError(f"unknown keys {', '.join(sorted(unknown))}")
+                entries.append(entry)
+    except (OSError, ValueError) as err:
+        print(f"Error: couldn't read {filename} (line {number}): {err}")
+        exit(1)
+    return entries
+
+
+def run_batch(command, entries, options):
+    """
+    Generate the ADEs of many folders: the folders are read and checked concurrently, then their patients are
+    created one folder at a time, sharing the userInfo and pipeline results. A failing folder doesn't stop the others
+    :param command: uploader command
+    :param entries: list of dicts with a "folder" and optional MANIFEST_KEYS
+    :param options: parsed command line arguments, -o is the folder the ADEs are written to
+    :return: exit code of the first folder that failed, or 0
+    """
+
+    out_folder = options.output if options.output else "."
+    os.makedirs(out_folder, exist_ok=True)
+
+    # Per folder options, and ADE/manifest names that don't clash
+    jobs = []
+    names = set()
+    for entry in entries:
+        folder_options = argparse.Namespace(**vars(options))
+        for key, option in MANIFEST_KEYS.items():
+            if key in entry:
+                setattr(folder_options, option, entry[key])
+        if "output" not in entry:
+            name = pathlib.PurePath(entry["folder"]).name or "ade"
+            _i = 1
+            while f"{name}.json" in names:
+                _i += 1
+                name = f"{pathlib.PurePath(entry['folder']).name}_{_i}"
+            names.add(f"{name}.json")
+            folder_options.output = os.path.join(out_folder, f"{name}.json")
+        if options.checksums and "checksums" not in entry:
+            folder_options.checksums = f"{folder_options.output}.checksums.tsv"
+        jobs.append((entry["folder"], folder_options))
+
+    print(f"Reading {len(jobs)} folders")
+    if options.workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(options.workers) as executor:
+            read = list(executor.map(_read_folder_quietly, *zip(*jobs)))
+    else:
+        read = [_read_folder_quietly(_folder, _options) for _folder, _options in jobs]
+
+    results = dict()
+    summary = []
+    for (folder, folder_options), (code, patient_data, output, stages) in zip(jobs, read):
+        if options.workers > 1:
+            # Recorded in a worker process
+            for stage in stages:
+                Timings.record(stage.pop("stage"), stage.pop("wall"), stage.pop("cpu", None), **stage)
+        print(f"=== {folder}")
+        print(output, end="")
+        if code == 0:
+            try:
+                code = generate_ade(command, folder, patient_data, folder_options, folder_options.output,
+                                    folder_options.checksums, results)
+            except Exception as err:
+                print(f"Error: {err}")
+                code = 1
+        summary.append({"folder": folder, "exit": code, "output": folder_options.output if code == 0 else None})
+
+    print("=== Summary")
+    for item in summary:
+        print(f"{item['exit']:3}  {item['folder']}" + (f" -> {item['output']}" if item["output"] else ""))
+    failed = [item for item in summary if item["exit"] != 0]
+    print(f"{len(summary) - len(failed)} of {len(summary)} folders done")
+    atomic_write(os.path.join(out_folder, "summary.json"), json.dumps(summary, indent=3))
+
+    return failed[0]["exit"] if failed else 0
 
 
 if __name__ == "__main__":
     # Parse the command line args
     _parser = argparse.ArgumentParser(description="Generate ADE file from FastQ folder")
-    _parser.add_argument("folder", help="Path to a folder containing FastQ files")
-    _parser.add_argument("-j", "--jar", default="./sg-upload-v2-latest.jar",
-                         help="Location of sg-upload-v2-latest.jar (defaults to ./sg-upload-v2-latest.jar)")
-    _parser.add_argument("-o", "--output", help="Output Json file (overwites without warning)")
+    _parser.add_argument("folder", nargs="*",
+                         help="Path to a folder containing FastQ files, several folders are processed as a batch")
+    _parser.add_argument("-j", "--jar", default=os.environ.get("SG_UPLOADER_JAR", "./sg-upload-v2-latest.jar"),
+                         help="Location of sg-upload-v2-latest.jar (defaults to $SG_UPLOADER_JAR or "
+                              "./sg-upload-v2-latest.jar). A .py file, e.g. bench/fake_uploader.py, is run with python")
+    _parser.add_argument("-o", "--output",
+                         help="Output Json file (overwites without warning), or the folder of the Json files and "
+                              "summary.json of a batch (defaults to the current folder)")
     _parser.add_argument("-r", "--ref", help="A name for the run")
     _parser.add_argument("-p", "--pipeline", default=-1, help="ID of pipeline")
     _parser.add_argument("-s", "--sampletype", default=108000,
                          help="sampleTypeId to apply to all samples - defaults to 108000 (Peripheral Blood)")
     _parser.add_argument("-c", "--confirm", action="store_true", help="Confirm use of script")
     _parser.add_argument("-i", "--clientId", help="Client ID for the data")
+    _parser.add_argument("--remember-auth", action="store_true",
+                         help="With --clientId, ask for the username, password and each grid card token only once per "
+                              "run instead of for every uploader call (they are only kept in memory)")
+    _parser.add_argument("--prompt-timeout", type=float, default=AuthHelper.PROMPT_TIMEOUT, metavar="SECONDS",
+                         help="Seconds to wait for the uploader's token prompt with --clientId (defaults to "
+                              f"{AuthHelper.PROMPT_TIMEOUT})")
     _parser.add_argument("-d", "--deep", action="store_true", help="Recurse through target folder")
+    _parser.add_argument("-e", "--exclude", action="append",
+                         help="Glob of folder names to skip when recursing (repeatable, replaces the defaults "
+                              f"{' '.join(PatientHelper.EXCLUDE_DIRS)})")
+    _parser.add_argument("--index", nargs="?", const="",
+                         help="Cache file classifications between runs in a scan index (defaults to a hidden file "
+                              "next to the folder)")
+    _parser.add_argument("-w", "--workers", type=int, default=1,
+                         help="Number of processes classifying files, or folders read at once in a batch (defaults "
+                              "to 1)")
+    _parser.add_argument("-b", "--batch", metavar="MANIFEST",
+                         help="Process the folders of a manifest, one json object per line with a folder and "
+                              f"optionally {', '.join(MANIFEST_KEYS)}")
+    _parser.add_argument("--cache-ttl", type=int, default=0,
+                         help="Seconds to reuse userInfo and pipeline results of earlier runs, e.g. 86400 (defaults "
+                              "to 0, no cache). Use --refresh after logging in to the uploader as someone else")
+    _parser.add_argument("--refresh", action="store_true", help="Fetch userInfo and pipelines even if cached")
+    _parser.add_argument("--batch-size", type=int, default=PatientHelper.BATCH_SIZE,
+                         help=f"Patients per create/list call (defaults to {PatientHelper.BATCH_SIZE})")
+    _parser.add_argument("--batch-workers", type=int, default=1,
+                         help="Number of patient batches created at the same time (defaults to 1)")
+    _parser.add_argument("--settle", type=float, metavar="SECONDS",
+                         help="Leave out the patients with a FastQ file that changed in the last SECONDS or doesn't "
+                              "end with a whole gzip member, e.g. while demultiplexing is still running")
+    _parser.add_argument("--watch", action="store_true",
+                         help="Wait for the run to finish, classifying FastQ files as they are written, and build the "
+                              "ADE once a completion marker exists and nothing has changed for --quiet-period. Files "
+                              "still incomplete then are reported and the exit code is 10")
+    _parser.add_argument("--watch-timeout", type=float, metavar="SECONDS",
+                         help="Give up on a watched run that isn't complete after SECONDS (exit code 10)")
+    _parser.add_argument("--quiet-period", type=float, default=10, metavar="SECONDS",
+                         help="Seconds without new or growing files before a watched run is complete")
+    _parser.add_argument("--marker", action="append",
+                         help="File marking a complete run, in the folder or one of its parents (defaults to "
+                              f"{' and '.join(RunWatcher.COMPLETION_MARKERS)}, can be given more than once)")
+    _parser.add_argument("--verify", action="store_true",
+                         help="Check that every FastQ file is a complete gzip of whole FastQ records before creating "
+                              "patients (results are cached by file size and mtime)")
+    _parser.add_argument("--checksums", metavar="MANIFEST",
+                         help="Write the size, MD5 and SHA-256 of every FastQ file to a tab separated MANIFEST (next "
+                              "to each Json file in a batch). They are computed while the patients are created and "
+                              "cached by file size and mtime")
+    _parser.add_argument("--checksum-workers", type=int, default=4, help="Threads computing checksums")
+    _parser.add_argument("--compact", action="store_true", help="Write the Json without indentation or spaces")
+    _parser.add_argument("--timings", metavar="FILE",
+                         help="Append a json line with the wall and CPU time of each stage, the uploader calls and the "
+                              "peak RSS to FILE (- for stderr)")
+    _parser.add_argument("--profile", metavar="FILE", help="Write cProfile stats of the main thread to FILE")
     _parser.add_argument("-v", "--verbose", action="store_true", help="Debug mode")
     _parser.add_argument("-x", "--regex", help="Override regex")
     _parser.add_argument("-y", "--yaml", help="An override file for the CLI")
     _parser.set_defaults(verbose=False)
     _args = _parser.parse_args()
+    if not _args.folder and not _args.batch:
+        _parser.error("a folder or --batch is required")
+
+    if _args.timings:
+        Timings.enable()
+    if _args.profile:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
 
     if _args.verbose:
         debug = True
@@ -658,58 +2589,47 @@ if __name__ == "__main__":
     # Make sure we have the upload CLI and set the upload command
     JAR_COMMAND = ["java", "-jar"]
     if os.path.exists(_args.jar):
+        _options = []
         if _args.yaml:
             if os.path.exists(_args.yaml):
-                JAR_COMMAND += [f"-Dmicronaut.config.files={_args.yaml}"]
+                _options = [f"-Dmicronaut.config.files={_args.yaml}"]
             else:
                 print(f"Couldn't find {_args.yaml}")
                 exit(7)
-        JAR_COMMAND += [_args.jar]
+        if _args.jar.endswith(".py"):
+            # Scripts like sg-upload-v2-wrapper.py take the config override after their name
+            JAR_COMMAND = [sys.executable, _args.jar] + _options
+        else:
+            JAR_COMMAND += _options + [_args.jar]
         print(JAR_COMMAND)
     else:
         print(f"Error: {_args.jar} not found")
         exit(6)
 
-    # Parse the patient data from files in fastqfolder
-    _patient_data = PatientHelper.read(os.path.join(os.getcwd(), _args.folder), _args.deep, _args.regex)
-    if _patient_data is None or len(_patient_data) == 0:
-        print("No patient data found")
-        exit(1)
-    elif not PatientHelper.is_valid(_patient_data):
-        exit(2)
-
-    # Get a dict of {patient_ref: (personalID, medicalId), . . . } for each patient
-    _patients_ids = PatientHelper.create_patients(JAR_COMMAND[:], _patient_data, _args.clientId)
-    if _patients_ids is None:
-        exit(3)
+    _entries = [{"folder": _folder} for _folder in _args.folder]
+    if _args.batch:
+        _entries += read_manifest(_args.batch)
+    if len(_entries) > 1 and _args.watch:
+        _parser.error("--watch takes a single folder")
 
-    # Get user info
-    _user_id, _client_id = UserHelper.get_user_info(JAR_COMMAND[:])
-    if _args.clientId:
-        _client_id = int(_args.clientId)
-    if _user_id == -1 or _client_id == -1:
-        exit(4)
-
-    # Get pipeline info
-    _pipeline_id, _sequencer_id = UserHelper.get_pipeline(JAR_COMMAND[:], _args.pipeline)
-    if _sequencer_id == -1:
-        exit(5)
-
-    # Get userRef
-    if _args.ref:
-        _user_ref = _args.ref
-    else:
-        _user_ref = f'{pathlib.PurePath(_args.folder).name}_{datetime.datetime.now().strftime("%Y%m%d%H%M")}'
+    AuthHelper.remember = _args.remember_auth
+    AuthHelper.timeout = _args.prompt_timeout
 
-    # Put the ADE together
-    _ade_json = JsonBuilder.build_json(_user_ref, _user_id, _client_id,
-                                       _pipeline_id, _sequencer_id, _patient_data, _patients_ids, _args.sampletype)
+    if _args.cache_ttl > 0:
+        UserHelper.cache = UploaderCache(UploaderCache.default_path(), UploaderCache.key(_args.jar, _args.yaml),
+                                         _args.cache_ttl, _args.refresh)
 
-    # Write to file if given, otherwise print to console
-    if _args.output:
-        save_path = os.path.join(os.getcwd(), _args.output)
-        with open(save_path, "w") as f_out:
-            f_out.write(_ade_json)
-        print(f"Json written to {save_path}")
+    if len(_entries) == 1 and not _args.batch:
+        # Parse the patient data from files in fastqfolder
+        _code, _patient_data = read_folder(_args.folder[0], _args, _args.workers)
+        if _code == 0:
+            _code = generate_ade(JAR_COMMAND, _args.folder[0], _patient_data, _args, _args.output, _args.checksums)
     else:
-        print(_ade_json)
+        _code = run_batch(JAR_COMMAND, _entries, _args)
+
+    if _args.profile:
+        _profiler.disable()
+        _profiler.dump_stats(_args.profile)
+    if _args.timings:
+        Timings.write(_args.timings, code=_code, folders=len(_entries))
+    exit(_code)
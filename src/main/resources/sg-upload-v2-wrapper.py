@@ -19,95 +19,803 @@
 # python3 sg-upload-v2-wrapper.py login -u some -p secret
 # python3 sg-upload-v2-wrapper.py new --legacy -j some-bar.json
 # python3 sg-upload-v2-wrapper.py status --id 200005105
+# python3 sg-upload-v2-wrapper.py status-many 200005105 200005106 (or -f ids.txt, or - for stdin)
 # etc.
 
+# Each version is downloaded in chunks into sg-upload-v2-jars/<checksum>.jar.part and only renamed to
+# sg-upload-v2-jars/<checksum>.jar once its checksum matches; an interrupted download is resumed on the next run.
+# sg-upload-v2-latest.jar is then switched to the new version atomically, and the uploader is started from the
+# versioned jar, so a running uploader never sees a jar change under it. Checks and downloads hold
+# sg-upload-v2-latest.jar.lock: while one process downloads, the others use the previous jar (or wait for the first one).
+# SG_UPLOADER_URL overrides remote_url, e.g. for a local mirror. SG_UPLOADER_JAR runs the given jar instead, without
+# checking for updates; a .py file (e.g. bench/fake_uploader.py, an offline stand-in) is run with this python.
+
+# The result of the last remote check and the checksum of the local jar are kept in sg-upload-v2-latest.jar.state. The
+# remote checksum is only fetched again after SG_UPLOADER_CHECK_INTERVAL seconds (default 3600, 0 checks every run),
+# with a SG_UPLOADER_TIMEOUT seconds (default 10) connect/read timeout, which also applies to each read of a download.
+# With SG_UPLOADER_BACKGROUND_CHECK=1 an existing jar is started straight away while the check runs next to it.
+# Without a jar, a process waits at most SG_UPLOADER_LOCK_TIMEOUT seconds (default 600) for another one to download
+# it.
+
+# The wrapper exits with the uploader's exit code. With SG_UPLOADER_OUTPUT=events, stdout carries json lines instead of
+# the raw output: "start", one "output" event per line plus "progress", "upload_id" and "error" events recognised in
+# it, and a final "exit" event with the exit code; the wrapper's own messages go to stderr.
+
+# Session helper:
+# python3 sg-upload-v2-wrapper.py serve [socket path]
+# checks for updates once and then runs uploader commands sent over a Unix socket (SG_UPLOADER_SOCKET, defaults to
+# sg-uploader.sock in $XDG_RUNTIME_DIR or ~/.cache/sg-uploader). The socket is created private to the user, and
+# clients ignore a socket that belongs to someone else. While it is running, the short non-interactive commands of this
+# wrapper (status, status-many, userInfo, pipeline, patient) are passed to it and run in the caller's directory; without
+# it every call starts its own uploader as before. A command is stopped when its client goes away.
+
 
 import urllib.request
+import urllib.error
 import hashlib
 import sys
 import subprocess
 import ssl
+import os
+import json
+import socket
+import socketserver
+import stat
+import tempfile
+import threading
+import time
+import shutil
+import string
+import argparse
+import contextlib
+import concurrent.futures
+import re
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
 
 # In case of "[SSL: CERTIFICATE_VERIFY_FAILED] certificate verify faile" error please uncomment the following line
 # see https://support.sectigo.com/articles/Knowledge/Sectigo-AddTrust-External-CA-Root-Expiring-May-30-2020
 # ssl._create_default_https_context = ssl._create_unverified_context
 
 
-remote_url = "https://ddm.sophiagenetics.com/direct/sg/uploaderv2"
+remote_url = os.environ.get("SG_UPLOADER_URL", "https://ddm.sophiagenetics.com/direct/sg/uploaderv2")
 uploader_filename = "sg-upload-v2-latest.jar"
 upload_checksum_filename = "sg-upload-v2-latest.jar.md5"
+state_filename = "sg-upload-v2-latest.jar.state"
+lock_filename = "sg-upload-v2-latest.jar.lock"
+jar_cache_dir = "sg-upload-v2-jars"
+kept_versions = 3
+download_chunk_size = 1024 * 1024
+
+check_interval = float(os.environ.get("SG_UPLOADER_CHECK_INTERVAL", "3600"))
+network_timeout = float(os.environ.get("SG_UPLOADER_TIMEOUT", "10"))
+lock_timeout = float(os.environ.get("SG_UPLOADER_LOCK_TIMEOUT", "600"))
+background_check = os.environ.get("SG_UPLOADER_BACKGROUND_CHECK", "") == "1"
+output_mode = os.environ.get("SG_UPLOADER_OUTPUT", "")
+jar_override = os.environ.get("SG_UPLOADER_JAR", "")
+config_override_option = "-Dmicronaut.config.files="
 
+# Commands that never prompt on stdin, so they can run in the session helper. Not new: an upload runs for long and
+# should stay a child of the terminal it was started from
+session_commands = ["status", "userInfo", "pipeline", "patient"]
 
-def get_remote_checksum():
+
+def get_remote_checksum(state=None):
+    """
+    Fetch the remote checksum, sending the ETag of the previous check so an unchanged checksum costs a 304.
+    The result is recorded in state if given.
+    """
     url = "%s/%s" % (remote_url, upload_checksum_filename)
+    if state is None:
+        state = {}
+    request = urllib.request.Request(url)
+    if state.get("etag") and state.get("remote_checksum"):
+        request.add_header("If-None-Match", state["etag"])
     try:
-        response = urllib.request.urlopen(url)
-        if response.status != 200:
-            print("ERR. Remote version not found: %s " % url)
-            sys.exit(1)
-        md5sum = response.read().decode('utf-8')
-        return md5sum
+        with urllib.request.urlopen(request, timeout=network_timeout) as response:
+            if response.status != 200:
+                print("ERR. Remote version not found: %s " % url)
+                sys.exit(1)
+            md5sum = response.read().decode('utf-8')
+            state["etag"] = response.headers.get("ETag")
+    except urllib.error.HTTPError as err:
+        if err.code != 304:
+            print("ERROR: Problem connecting to %s " % url)
+            print("ERROR: %s " % err)
+            return ""
+        md5sum = state["remote_checksum"]
     except Exception as err:
         print("ERROR: Problem connecting to %s " % url)
         print("ERROR: %s " % err)
         return ""
 
+    state["remote_checksum"] = md5sum
+    state["checked_at"] = time.time()
+    return md5sum
+
+
+def get_current_checksum(state=None):
+    """
+    MD5 of the local jar. The checksum is kept in state for the jar's size and mtime, so an unchanged jar isn't
+    read again.
+    """
+    if state is None:
+        state = {}
+    try:
+        stat = os.stat(uploader_filename)
+    except FileNotFoundError:
+        return ""  # return empty checksum if no file found
+
+    local = state.get("local") or {}
+    if local.get("size") == stat.st_size and local.get("mtime") == stat.st_mtime_ns and local.get("md5"):
+        return local["md5"]
 
-def get_current_checksum():
     hash_md5 = hashlib.md5()
     try:
         with open(uploader_filename, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
+            for chunk in iter(lambda: f.read(download_chunk_size), b""):
                 hash_md5.update(chunk)
-        return hash_md5.hexdigest()
     except FileNotFoundError:
-        return ""  # return empty checksum if no file found
+        return ""
+    state["local"] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "md5": hash_md5.hexdigest()}
+    return state["local"]["md5"]
+
+
+def load_state():
+    try:
+        with open(state_filename, "r") as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state):
+    try:
+        with tempfile.NamedTemporaryFile("w", dir=".", prefix=".tmp-", delete=False) as f:
+            json.dump(state, f)
+        os.replace(f.name, state_filename)
+    except OSError as err:
+        print("WARN. Couldn't save %s: %s" % (state_filename, err))
+
+
+def update_self(remote_checksum, state=None):
+    """
+    Make sure sg-upload-v2-jars/<remote_checksum>.jar exists, streaming it into a partial file which is hashed on the
+    way and only renamed once it matches, then switch sg-upload-v2-latest.jar to it. An interrupted download is
+    resumed with an HTTP Range request on the next update. Must be called holding the update lock.
+    Returns whether the jar was updated.
+    """
+    remote_checksum = remote_checksum.strip()
+    if len(remote_checksum) != 32 or any(c not in string.hexdigits for c in remote_checksum):
+        print("ERROR: Remote checksum %r isn't an MD5. Using previous version!" % remote_checksum)
+        return False
+
+    versioned = versioned_jar(remote_checksum)
+    if not os.path.exists(versioned):
+        os.makedirs(jar_cache_dir, exist_ok=True)
+        partial = versioned + ".part"
+        resumed = download(partial)
+        if resumed is None:
+            return False
+
+        downloaded_checksum, was_resumed = resumed
+        if downloaded_checksum != remote_checksum and was_resumed:
+            # The partial file may be corrupt; start over once
+            os.remove(partial)
+            resumed = download(partial)
+            if resumed is None:
+                return False
+            downloaded_checksum, _ = resumed
+
+        if downloaded_checksum != remote_checksum:
+            print("ERROR: Downloaded checksum %s doesn't match remote checksum %s. Using previous version!"
+                  % (downloaded_checksum, remote_checksum))
+            os.remove(partial)
+            return False
+
+        os.replace(partial, versioned)
+
+    if not switch_latest(versioned):
+        return False
+
+    if state is not None:
+        stat = os.stat(uploader_filename)
+        state["local"] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "md5": remote_checksum}
+    prune_versions(versioned)
+    return True
+
+
+def versioned_jar(checksum):
+    return os.path.join(jar_cache_dir, "%s.jar" % checksum)
+
+
+def switch_latest(versioned):
+    """
+    Atomically point sg-upload-v2-latest.jar at a versioned jar, as a hard link if possible, otherwise as a copy
+    """
+    temporary = "%s.%d.tmp" % (uploader_filename, os.getpid())
+    try:
+        try:
+            os.link(versioned, temporary)
+        except OSError:
+            shutil.copy2(versioned, temporary)
+        os.replace(temporary, uploader_filename)
+    except OSError as err:
+        # e.g. Windows refuses to replace a jar that a running uploader has open
+        print("WARN. Couldn't replace %s: %s. Using previous version!" % (uploader_filename, err))
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        return False
+    return True
 
 
-def update_self():
+def prune_versions(current):
+    """
+    Remove all but the newest kept_versions jars. A jar still in use is skipped where the OS refuses to remove it;
+    elsewhere the running uploader keeps its open copy.
+    """
+    jars = [os.path.join(jar_cache_dir, name) for name in os.listdir(jar_cache_dir) if name.endswith(".jar")]
+    jars.sort(key=os.path.getmtime, reverse=True)
+    for jar in jars[kept_versions:]:
+        if not os.path.samefile(jar, current):
+            try:
+                os.remove(jar)
+            except OSError:
+                pass
+
+
+def launch_jar(state):
+    """
+    The jar to start: the immutable versioned copy of the current jar if there is one, else sg-upload-v2-latest.jar
+    """
+    current = get_current_checksum(state)
+    if current and os.path.exists(versioned_jar(current)):
+        return versioned_jar(current)
+    return uploader_filename
+
+
+def acquire_lock(lock, blocking, timeout=None):
+    """
+    Lock the open lock file across processes. Returns False if it is held elsewhere and blocking is False, or still
+    held after timeout seconds.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        try:
+            if os.name == "nt":
+                lock.seek(0)
+                msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            if not blocking or (deadline is not None and time.time() >= deadline):
+                return False
+            time.sleep(0.2)
+
+
+def release_lock(lock):
+    if os.name == "nt":
+        lock.seek(0)
+        msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def download(filename):
+    """
+    Download the jar into filename, continuing from its current size if it exists.
+    Returns (md5 of the whole file, whether the download was resumed) or None if the download failed.
+    """
     update_url = "%s/%s" % (remote_url, uploader_filename)
-    response = urllib.request.urlopen(update_url)
-    me = open(uploader_filename, 'wb')
-    me.write(response.read())
-    me.close()
+    hash_md5 = hashlib.md5()
+    offset = 0
+    if os.path.exists(filename):
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(download_chunk_size), b""):
+                hash_md5.update(chunk)
+                offset += len(chunk)
+
+    request = urllib.request.Request(update_url)
+    if offset > 0:
+        print("Resuming download at %d bytes" % offset)
+        request.add_header("Range", "bytes=%d-" % offset)
+
+    try:
+        # The timeout applies to every read, so a stalled download fails instead of holding the update lock forever.
+        # read1 returns what has arrived, so the partial file keeps it for the next attempt
+        with urllib.request.urlopen(request, timeout=network_timeout) as response:
+            if offset > 0 and response.status != 206:
+                # Range not supported; start over
+                offset = 0
+                hash_md5 = hashlib.md5()
+            with open(filename, "ab" if offset > 0 else "wb") as out:
+                for chunk in iter(lambda: response.read1(download_chunk_size), b""):
+                    out.write(chunk)
+                    hash_md5.update(chunk)
+    except urllib.error.HTTPError as err:
+        # 416: the partial file already holds the whole jar
+        if not (err.code == 416 and offset > 0):
+            print("ERROR: Problem downloading %s " % update_url)
+            print("ERROR: %s " % err)
+            return None
+    except Exception as err:
+        print("ERROR: Problem downloading %s, will resume on the next update " % update_url)
+        print("ERROR: %s " % err)
+        return None
+
+    return hash_md5.hexdigest(), offset > 0
+
+
+def is_fresh(state):
+    """
+    Whether the last check is recent enough to trust, and the local jar is still the one it found
+    """
+    return time.time() - state.get("checked_at", 0) < check_interval and bool(state.get("remote_checksum")) \
+        and get_current_checksum(state) == state["remote_checksum"].strip()
+
+
+def check_for_update():
+    """
+    Update the local jar if needed. Returns the jar to start.
+    """
+    if jar_override:
+        return jar_override
+
+    state = load_state()
+    if is_fresh(state):
+        print("Script is up-to-date (checksum {0}, checked {1:.0f}s ago)".format(
+            state["remote_checksum"].strip(), time.time() - state["checked_at"]))
+        return launch_jar(state)
+
+    with open(lock_filename, "a") as lock:
+        if not acquire_lock(lock, blocking=False):
+            if os.path.exists(uploader_filename):
+                print("WARN. Another process is updating the uploader. Using previous version!")
+                return launch_jar(state)
+            print("Waiting for another process to download the uploader")
+            if not acquire_lock(lock, blocking=True, timeout=lock_timeout):
+                print("ERROR: Another process has been downloading the uploader for %.0fs, giving up "
+                      "(see SG_UPLOADER_LOCK_TIMEOUT)" % lock_timeout)
+                sys.exit(1)
+
+        try:
+            # Another process may have finished the update in the meantime
+            state = load_state()
+            if is_fresh(state):
+                print("Script is up-to-date (checksum {0})".format(state["remote_checksum"].strip()))
+                return launch_jar(state)
+
+            remote_checksum = get_remote_checksum(state)
+
+            if remote_checksum == "":
+                print("WARN. No new version found. Using previous one!")
+            else:
+                current_checksum = get_current_checksum(state)
+                if current_checksum == "":
+                    print("Downloading latest uploader version. Checksum: {0}.".format(remote_checksum))
+                    update_self(remote_checksum, state)
+                else:
+                    remote_checksum = remote_checksum.strip()
+                    current_checksum = current_checksum.strip()
+                    if remote_checksum != current_checksum:
+                        print("Current checksum: %s" % current_checksum)
+                        print("Remote checksum: %s" % remote_checksum)
+                        if update_self(remote_checksum, state):
+                            print("Updated to version {0}.".format(remote_checksum))
+                    else:
+                        print("Script is up-to-date (checksum {0})".format(remote_checksum))
+
+            save_state(state)
+            return launch_jar(state)
+        finally:
+            release_lock(lock)
 
 
 def main():
-    remote_checksum = get_remote_checksum()
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        serve(sys.argv[2] if len(sys.argv) > 2 else session_socket_path())
+        return
+
+    options, uploader_args = split_args(sys.argv)
+    if len(uploader_args) > 0 and uploader_args[0] == "status-many":
+        sys.exit(status_many(options, uploader_args[1:]))
 
-    if remote_checksum == "":
-        print("WARN. No new version found. Using previous one!")
+    if output_mode == "events":
+        # stdout only carries events; the wrapper's own messages go to stderr
+        relay = EventRelay(sys.stdout)
+        sys.stdout = sys.stderr
+        relay.emit("start", args=uploader_args)
+        on_output = relay.line
     else:
-        current_checksum = get_current_checksum()
-        if current_checksum == "":
-            print("Downloading latest uploader version. Checksum: {0}.".format(remote_checksum))
-            update_self()
+        relay = None
+        on_output = relay_output
+
+    returncode = run_in_session(sys.argv, on_output)
+    checker = None
+    if returncode is None:
+        if background_check and not jar_override and os.path.exists(uploader_filename):
+            # Start the current jar right away; an update only affects the next run
+            checker = threading.Thread(target=check_in_background)
+            checker.start()
+            jar = launch_jar(load_state())
         else:
-            remote_checksum = remote_checksum.strip()
-            current_checksum = current_checksum.strip()
-            if remote_checksum != current_checksum:
-                print("Current checksum: %s" % current_checksum)
-                print("Remote checksum: %s" % remote_checksum)
-                update_self()
-                print("Updated to version {0}.".format(remote_checksum))
-            else:
-                print("Script is up-to-date (checksum {0})".format(remote_checksum))
+            jar = check_for_update()
+
+        cmd = build_command(sys.argv, jar)
+
+        # Our own messages must come out before the uploader's
+        sys.stdout.flush()
+        if relay is None:
+            # The uploader writes straight to our stdout/stderr, so its output is never held back
+            returncode = subprocess.run(cmd).returncode
+        else:
+            returncode = run_streaming(cmd, on_output)
+
+    if relay is not None:
+        relay.emit("exit", returncode=returncode)
+    if checker is not None:
+        checker.join()
+
+    sys.exit(returncode)
+
+
+def check_in_background():
+    """
+    check_for_update next to a running uploader, with its messages on stderr so they don't end up in the uploader's
+    output that callers parse
+    """
+    with contextlib.redirect_stdout(sys.stderr):
+        check_for_update()
+
+
+def run_streaming(cmd: list, on_output):
+    """
+    Run the uploader, handing each line of stdout and stderr to on_output(stream, data) as soon as it is written.
+    Returns the exit code.
+    """
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
+
+    def _relay(stream, name):
+        for line in stream:
+            on_output(name, line)
+
+    relay_err = threading.Thread(target=_relay, args=(process.stderr, "stderr"), daemon=True)
+    relay_err.start()
+    _relay(process.stdout, "stdout")
+    relay_err.join()
+    return process.wait()
+
+
+class EventRelay:
+    """
+    Turns uploader output into json lines: every line becomes an "output" event, and lines that report progress, an
+    upload id or an error also give a "progress", "upload_id" or "error" event. Every event carries "t", the seconds
+    since the wrapper started.
+    """
 
-    cmd = build_command(sys.argv)
+    progress_re = re.compile(r"(\d{1,3}(?:\.\d+)?)\s?%")
+    upload_id_re = re.compile(r"\bid\b\W{0,4}(\d{4,})", re.IGNORECASE)
+    error_re = re.compile(r"\b(ERROR|Exception|FAILED)\b")
 
-    _ = subprocess.run(cmd)
+    def __init__(self, out):
+        self.out = out
+        self.start = time.time()
+        self.lock = threading.Lock()
 
+    def emit(self, event: str, **fields):
+        record = {"event": event, "t": round(time.time() - self.start, 3)}
+        record.update(fields)
+        with self.lock:
+            self.out.write(json.dumps(record) + "\n")
+            self.out.flush()
 
-def build_command(args: list):
+    def line(self, stream: str, data: str):
+        data = data.rstrip("\n")
+        self.emit("output", stream=stream, line=data)
+
+        progress = self.progress_re.search(data)
+        if progress:
+            self.emit("progress", percent=float(progress.group(1)))
+        upload_id = self.upload_id_re.search(data)
+        if upload_id:
+            self.emit("upload_id", id=upload_id.group(1))
+        if stream == "stderr" or self.error_re.search(data):
+            self.emit("error", stream=stream, line=data)
+
+
+def status_many(options: list, args: list):
+    """
+    Poll the status of many upload ids with a bounded pool, printing one json line per id as soon as it is known.
+    Polls go through the session helper when it is running; otherwise the update check runs once for all of them.
+    Returns 0 if every poll succeeded, 1 otherwise.
+    """
+    parser = argparse.ArgumentParser(prog="sg-upload-v2-wrapper.py status-many",
+                                     description="Poll the status of many uploads")
+    parser.add_argument("ids", nargs="*", help="Upload ids; '-' reads ids from stdin")
+    parser.add_argument("-f", "--file", help="File with one upload id per line")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Polls running at the same time (default 4)")
+    parser.add_argument("-r", "--retries", type=int, default=3, help="Retries of a failed poll (default 3)")
+    parser.add_argument("-b", "--backoff", type=float, default=2.0,
+                        help="Seconds before the first retry, doubled for each further retry (default 2)")
+    parsed = parser.parse_args(args)
+    if parsed.retries < 0:
+        parser.error("--retries must be 0 or more")
+    if parsed.backoff < 0:
+        parser.error("--backoff must be 0 or more")
+
+    ids = [i for i in parsed.ids if i != "-"]
+    if "-" in parsed.ids:
+        ids += [line.strip() for line in sys.stdin]
+    if parsed.file:
+        with open(parsed.file, "r") as f:
+            ids += [line.strip() for line in f]
+    ids = list(dict.fromkeys(i for i in ids if i and not i.startswith("#")))
+    if len(ids) == 0:
+        print("ERROR: No upload ids given")
+        return 1
+
+    jar = None
+    jar_lock = threading.Lock()
+    print_lock = threading.Lock()
+    records = sys.stdout
+
+    def _run(upload_id):
+        nonlocal jar
+        argv = ["status-many"] + options + ["status", "--id", upload_id]
+        output = {"stdout": [], "stderr": []}
+        returncode = run_in_session(argv, lambda stream, data: output[stream].append(data))
+        if returncode is None:
+            with jar_lock:
+                if jar is None:
+                    # Only the first poll that can't use the helper checks for updates; keep its chatter off stdout
+                    with contextlib.redirect_stdout(sys.stderr):
+                        jar = check_for_update()
+            result = subprocess.run(build_command(argv, jar), capture_output=True, text=True)
+            returncode, output = result.returncode, {"stdout": [result.stdout], "stderr": [result.stderr]}
+        return returncode, "".join(output["stdout"]), "".join(output["stderr"])
+
+    def _poll(upload_id):
+        start = time.time()
+        for attempt in range(parsed.retries + 1):
+            if attempt > 0:
+                time.sleep(parsed.backoff * 2 ** (attempt - 1))
+            returncode, stdout, stderr = _run(upload_id)
+            if returncode == 0:
+                break
+
+        record = {"id": upload_id, "returncode": returncode, "attempts": attempt + 1,
+                  "elapsed": round(time.time() - start, 3), "stdout": stdout, "stderr": stderr}
+        try:
+            record["status"] = json.loads(stdout)
+        except ValueError:
+            pass
+        with print_lock:
+            records.write(json.dumps(record) + "\n")
+            records.flush()
+        return returncode
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, parsed.workers)) as executor:
+        returncodes = list(executor.map(_poll, ids))
+
+    return 0 if all(code == 0 for code in returncodes) else 1
+
+
+def split_args(args: list):
+    """
+    :return: (config override options, uploader arguments) of the wrapper's argv
+    """
+    if len(args) > 1 and config_override_option in args[1]:
+        return [args[1]], args[2:]
+    return [], args[1:]
+
+
+def session_socket_path():
+    folder = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "sg-uploader")
+    return os.environ.get("SG_UPLOADER_SOCKET", os.path.join(folder, "sg-uploader.sock"))
+
+
+def is_trusted_socket(path):
+    """
+    Only a socket owned by this user and accessible to nobody else is used, so another user can't bind the path first
+    to read the commands or answer them
+    """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    if not stat.S_ISSOCK(info.st_mode):
+        return False
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        print("WARN. Ignoring session helper socket %s, it isn't private to this user" % path)
+        return False
+    return True
+
+
+def relay_output(stream, data):
+    out = sys.stderr if stream == "stderr" else sys.stdout
+    out.write(data)
+    out.flush()
+
+
+def run_in_session(args: list, on_output=relay_output):
+    """
+    Pass the command to a running session helper, handing each line of its output to on_output(stream, data).
+    Returns the exit code, or None if the command should be run here instead.
+    """
+    options, uploader_args = split_args(args)
+    if len(uploader_args) == 0 or uploader_args[0] not in session_commands or "--client-id" in uploader_args:
+        return None
+
+    path = session_socket_path()
+    if not hasattr(socket, "AF_UNIX") or not is_trusted_socket(path):
+        return None
+
+    request = {"options": options, "args": uploader_args, "jar": os.path.abspath(jar_override or uploader_filename),
+               "cwd": os.getcwd()}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    # Once connected the helper may have started the command, so it is never run a second time here
+    try:
+        with sock, sock.makefile("rw", encoding="utf-8") as stream:
+            stream.write(json.dumps(request) + "\n")
+            stream.flush()
+            for line in stream:
+                event = json.loads(line)
+                if "error" in event:
+                    # Refused before anything was run
+                    print("WARN. Session helper refused the command: %s" % event["error"])
+                    return None
+                if "returncode" in event:
+                    return event["returncode"]
+                on_output(event["stream"], event["data"])
+    except (OSError, ValueError) as err:
+        print("ERROR: Lost connection to session helper: %s" % err)
+        return 1
+
+    print("ERROR: Session helper closed the connection before the command finished")
+    return 1
+
+
+class SessionHandler(socketserver.StreamRequestHandler):
+    """
+    Runs one uploader command per connection, in the client's directory. The request is a json line with the config
+    override options, the uploader arguments, the jar the client expects and its working directory; stdout/stderr
+    lines and the exit code are sent back as json lines. The command is killed if the client goes away.
+    """
+
+    def handle(self):
+        self.lock = threading.Lock()
+        self.process = None
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            options = list(request.get("options", []))
+            args = list(request["args"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send({"error": "malformed request"})
+            return
+
+        if any(not str(option).startswith(config_override_option) for option in options):
+            self.send({"error": "only %s options are accepted" % config_override_option})
+            return
+        if len(args) == 0 or args[0] not in session_commands or "--client-id" in args:
+            self.send({"error": "interactive or unknown command"})
+            return
+        jar = request.get("jar")
+        if jar and not (os.path.exists(jar) and os.path.samefile(jar, self.server.jar)):
+            self.send({"error": "helper runs %s, not %s" % (self.server.jar, jar)})
+            return
+        cwd = request.get("cwd")
+        if not isinstance(cwd, str) or not os.path.isdir(cwd):
+            self.send({"error": "working directory %s not found" % cwd})
+            return
+
+        cmd = jar_command(self.server.jar, options, args)
+        process = self.process = subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                                  stderr=subprocess.PIPE, text=True)
+        relay_err = threading.Thread(target=self.relay, args=(process.stderr, "stderr"), daemon=True)
+        relay_err.start()
+        threading.Thread(target=self.watch_client, daemon=True).start()
+        self.relay(process.stdout, "stdout")
+        relay_err.join()
+        self.send({"returncode": process.wait()})
+
+    def watch_client(self):
+        """
+        Clients send nothing after the request, so the end of the stream means the client went away
+        """
+        try:
+            self.rfile.read()
+        except (OSError, ValueError):
+            pass
+        self.stop()
+
+    def stop(self):
+        # Nobody is left to see the output (e.g. Ctrl-C on the client), stop the command
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+
+    def relay(self, stream, name):
+        for line in stream:
+            self.send({"stream": name, "data": line})
+
+    def send(self, event):
+        with self.lock:
+            try:
+                self.wfile.write((json.dumps(event) + "\n").encode("utf-8"))
+                self.wfile.flush()
+            except OSError:
+                self.stop()
+
+
+class SessionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path):
+    if not hasattr(socket, "AF_UNIX"):
+        print("ERROR: Unix sockets are not available on this platform")
+        sys.exit(1)
+
+    jar = check_for_update()
+
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    info = os.stat(folder)
+    if info.st_uid != os.getuid() or info.st_mode & 0o022:
+        print("ERROR: %s must belong to you and not be writable by others" % folder)
+        sys.exit(1)
+
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(path)
+                print("ERROR: A session helper is already listening on %s" % path)
+                sys.exit(1)
+            except OSError:
+                os.remove(path)  # left over from a helper that didn't shut down cleanly
+    # Created private, so no other user can connect between bind and chmod
+    umask = os.umask(0o077)
+    try:
+        server = SessionServer(path, SessionHandler)
+    finally:
+        os.umask(umask)
+    server.jar = os.path.abspath(jar)
+    os.chmod(path, 0o600)
+    print("Session helper listening on %s" % path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def build_command(args: list, jar=uploader_filename):
     """
     The override should be the first option (index 1)
     """
-    command = ['java', '-jar']
-    if "-Dmicronaut.config.files=" in args[1]:
-        command += [args[1]] + [uploader_filename] + args[2:]
-    else:
-        command += [uploader_filename] + args[1:]
-    return command
+    options, uploader_args = split_args(args)
+    return jar_command(jar, options, uploader_args)
+
+
+def jar_command(jar: str, options: list, uploader_args: list):
+    """
+    Command starting the jar, or a .py stand-in with this python, which takes the options after its name
+    """
+    if jar.endswith(".py"):
+        return [sys.executable, jar] + options + uploader_args
+    return ['java', '-jar'] + options + [jar] + uploader_args
 
 
 if __name__ == "__main__":
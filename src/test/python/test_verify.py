@@ -0,0 +1,111 @@
+"""
+Completeness checks of adegen.py's --settle (VerifyHelper.check_tail and complete_files) on gzip files written here.
+
+    python3 -m unittest discover -s src/test/python
+"""
+
+import contextlib
+import gzip
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "main", "resources"))
+
+import adegen  # noqa: E402
+
+RECORDS = b"".join(b"@read%d\nACGT\n+\nIIII\n" % _i for _i in range(1000))
+
+
+class VerifyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.output = io.StringIO()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write(self, name, content, age=3600):
+        """
+        :param age: seconds since the file was last changed
+        :return: path of the file
+        """
+        path = os.path.join(self.folder.name, name)
+        with open(path, "wb") as f_out:
+            f_out.write(content)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def complete_files(self, files, settle):
+        with contextlib.redirect_stdout(self.output):
+            return adegen.VerifyHelper.complete_files(files, settle)
+
+    def test_bgzf_eof_block(self):
+        path = self.write("bgzf.fastq.gz", gzip.compress(RECORDS) + adegen.VerifyHelper.BGZF_EOF)
+        self.assertEqual(adegen.VerifyHelper.check_tail(path), (True, None))
+
+    def test_multi_member(self):
+        path = self.write("multi.fastq.gz", gzip.compress(RECORDS[:20000]) + gzip.compress(RECORDS[20000:]))
+        self.assertEqual(adegen.VerifyHelper.check_tail(path), (True, None))
+
+    def test_truncated_member(self):
+        second = gzip.compress(RECORDS[20000:])
+        path = self.write("trunc.fastq.gz", gzip.compress(RECORDS[:20000]) + second[:len(second) // 2])
+        self.assertEqual(adegen.VerifyHelper.check_tail(path), (False, "gzip ends mid-member"))
+
+    def test_not_gzip(self):
+        path = self.write("plain.fastq.gz", RECORDS)
+        self.assertEqual(adegen.VerifyHelper.check_tail(path), (False, "not a gzip file"))
+
+    def test_complete_files(self):
+        good = self.write("good.fastq.gz", gzip.compress(RECORDS))
+        truncated = self.write("trunc.fastq.gz", gzip.compress(RECORDS)[:-10])
+        complete, deferred = self.complete_files([good, truncated], 1)
+        self.assertEqual(complete, [good])
+        self.assertEqual(list(deferred), [truncated])
+        self.assertIn(f"Deferring {truncated}", self.output.getvalue())
+
+    def test_still_changing(self):
+        content = gzip.compress(RECORDS)
+        good = self.write("good.fastq.gz", content)
+        growing = self.write("growing.fastq.gz", content[:1000], age=0)
+
+        def _append():
+            time.sleep(0.2)
+            with open(growing, "ab") as f_out:
+                f_out.write(content[1000:])
+
+        writer = threading.Thread(target=_append)
+        writer.start()
+        complete, deferred = self.complete_files([good, growing], 1)
+        writer.join()
+        self.assertEqual(complete, [good])
+        self.assertEqual(deferred, {growing: "still being written"})
+
+    def test_future_mtime_waits_at_most_settle(self):
+        path = self.write("future.fastq.gz", gzip.compress(RECORDS), age=-3600)
+        start = time.time()
+        complete, deferred = self.complete_files([path], 0.5)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(complete, [path])
+
+    def test_read_defers_whole_patient(self):
+        content = gzip.compress(RECORDS)
+        self.write("P1-D_S1_L001_R1_001.fastq.gz", content[:-10])
+        self.write("P1-D_S1_L001_R2_001.fastq.gz", content)
+        self.write("P1-R_S2_L001_R1_001.fastq.gz", content)
+        self.write("P2_S3_L001_R1_001.fastq.gz", content)
+        with contextlib.redirect_stdout(self.output):
+            patient_data = adegen.PatientHelper.read(self.folder.name, False, None, settle=0.1)
+        self.assertEqual(list(patient_data), ["P2"])
+        self.assertIn("Deferring patient P1", self.output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
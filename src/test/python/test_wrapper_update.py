@@ -0,0 +1,181 @@
+"""
+Update and download of sg-upload-v2-wrapper.py against a local http.server, through SG_UPLOADER_URL.
+
+    python3 -m unittest discover -s src/test/python
+"""
+
+import contextlib
+import hashlib
+import http.server
+import importlib.util
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+WRAPPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "main", "resources",
+                       "sg-upload-v2-wrapper.py")
+
+JAR = bytes(range(256)) * 4096 + b"end of jar"
+CHECKSUM = hashlib.md5(JAR).hexdigest()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves server.files, with Range requests, and stalls a download half way if server.stall is set
+    """
+
+    def do_GET(self):
+        name = self.path.rsplit("/", 1)[-1]
+        self.server.requests.append((name, self.headers.get("Range")))
+        if name not in self.server.files:
+            self.send_error(404)
+            return
+        body = self.server.files[name]
+
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            if start >= len(body):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+
+        if self.server.stall and name.endswith(".jar"):
+            self.wfile.write(body[start:start + 1024])
+            self.wfile.flush()
+            self.server.release.wait(30)
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class WrapperUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.server.files = {"sg-upload-v2-latest.jar": JAR, "sg-upload-v2-latest.jar.md5": CHECKSUM.encode()}
+        self.server.requests = []
+        self.server.stall = False
+        self.server.release = threading.Event()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.folder.name)
+        self.output = io.StringIO()
+
+    def tearDown(self):
+        self.server.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    def load_wrapper(self, **env):
+        """
+        Import the wrapper with SG_UPLOADER_URL pointing at the test server, as its settings are read on import
+        """
+        env = dict({"SG_UPLOADER_URL": "http://127.0.0.1:%d/uploader" % self.server.server_address[1],
+                    "SG_UPLOADER_CHECK_INTERVAL": "0"}, **env)
+        saved = {key: os.environ.get(key) for key in list(env) + ["SG_UPLOADER_JAR"]}
+        os.environ.update(env)
+        os.environ.pop("SG_UPLOADER_JAR", None)
+        try:
+            spec = importlib.util.spec_from_file_location("sg_upload_v2_wrapper_test", WRAPPER)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+        return module
+
+    def check_for_update(self, wrapper):
+        with contextlib.redirect_stdout(self.output):
+            return wrapper.check_for_update()
+
+    def partial(self, content):
+        os.makedirs("sg-upload-v2-jars", exist_ok=True)
+        with open(os.path.join("sg-upload-v2-jars", CHECKSUM + ".jar.part"), "wb") as f:
+            f.write(content)
+
+    def assert_installed(self, jar):
+        self.assertEqual(jar, os.path.join("sg-upload-v2-jars", CHECKSUM + ".jar"))
+        for name in (jar, "sg-upload-v2-latest.jar"):
+            with open(name, "rb") as f:
+                self.assertEqual(f.read(), JAR)
+        self.assertFalse(os.path.exists(jar + ".part"))
+
+    def jar_requests(self):
+        return [_range for _name, _range in self.server.requests if _name.endswith(".jar")]
+
+    def test_download(self):
+        jar = self.check_for_update(self.load_wrapper())
+        self.assert_installed(jar)
+        self.assertEqual(self.jar_requests(), [None])
+
+    def test_resume(self):
+        self.partial(JAR[:300000])
+        jar = self.check_for_update(self.load_wrapper())
+        self.assert_installed(jar)
+        self.assertEqual(self.jar_requests(), ["bytes=300000-"])
+
+    def test_partial_already_complete(self):
+        # The server answers 416 to a range starting at the end of the jar
+        self.partial(JAR)
+        jar = self.check_for_update(self.load_wrapper())
+        self.assert_installed(jar)
+        self.assertEqual(self.jar_requests(), ["bytes=%d-" % len(JAR)])
+
+    def test_corrupt_partial_starts_over(self):
+        self.partial(b"x" * 1000)
+        jar = self.check_for_update(self.load_wrapper())
+        self.assert_installed(jar)
+        self.assertEqual(self.jar_requests(), ["bytes=1000-", None])
+
+    def test_checksum_mismatch(self):
+        self.server.files["sg-upload-v2-latest.jar"] = JAR[:-1]
+        jar = self.check_for_update(self.load_wrapper())
+        self.assertEqual(jar, "sg-upload-v2-latest.jar")
+        self.assertFalse(os.path.exists("sg-upload-v2-latest.jar"))
+        self.assertEqual(os.listdir("sg-upload-v2-jars"), [])
+        self.assertIn("doesn't match remote checksum", self.output.getvalue())
+
+    def test_stalled_download_times_out(self):
+        self.server.stall = True
+        wrapper = self.load_wrapper(SG_UPLOADER_TIMEOUT="1")
+        start = time.time()
+        self.check_for_update(wrapper)
+        self.assertLess(time.time() - start, 10)
+        self.assertIn("will resume on the next update", self.output.getvalue())
+        # What arrived is kept for the next attempt
+        self.assertEqual(os.path.getsize(os.path.join("sg-upload-v2-jars", CHECKSUM + ".jar.part")), 1024)
+
+    def test_lock_wait_times_out(self):
+        wrapper = self.load_wrapper(SG_UPLOADER_LOCK_TIMEOUT="1")
+        with open(wrapper.lock_filename, "a") as lock:
+            self.assertTrue(wrapper.acquire_lock(lock, blocking=False))
+            # A second open file description conflicts with flock, as another process would
+            start = time.time()
+            with self.assertRaises(SystemExit):
+                self.check_for_update(wrapper)
+            self.assertLess(time.time() - start, 10)
+            wrapper.release_lock(lock)
+        self.assertIn("giving up", self.output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()